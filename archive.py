@@ -0,0 +1,175 @@
+import os
+from datetime import date
+
+import ledger_cache
+import locks
+import storage
+import validation
+
+
+# Archiving setup. Closed years are archived automatically unless
+# CFM_ARCHIVE=0.
+ENABLED = os.environ.get("CFM_ARCHIVE", "1") != "0"
+
+
+def has_closed_years(first_date, today=None):
+    """
+    Checks if the ledger starts in a closed year, given the date of its
+    first dated refuel.
+    """
+    today = today or date.today()
+    return bool(first_date) and int(first_date[:4]) < today.year
+
+
+def closed_years(rows, today=None):
+    """
+    Function to group the leading rows of the ledger that fall in closed
+    years, the years before the current one.
+    Undated refuels belong to the year of the refuel before them, or of the
+    first dated refuel if they start the ledger.
+    Returns a list of (year, row indexes) tuples, in ledger order.
+    """
+    today = today or date.today()
+    first_date = next((row[3] for row in rows if row[3]), None)
+    if first_date is None:
+        return []
+    year = int(first_date[:4])
+    groups = []
+    for index, row in enumerate(rows):
+        if row[3]:
+            year = int(row[3][:4])
+        if year >= today.year:
+            break
+        if not groups or groups[-1][0] != year:
+            groups.append((year, []))
+        groups[-1][1].append(index)
+    return groups
+
+
+def previous_row(summaries):
+    """
+    Returns the last archived refuel as a validated (odo, quantity, cost,
+    date) row to carry the ledger checks on from, or None.
+    """
+    if not summaries:
+        return None
+    summary = summaries[-1]
+    return (
+        summary.last_odo, summary.last_quantity, summary.last_cost,
+        summary.last_date
+        )
+
+
+def summarise(year, rows, previous=None):
+    """
+    Function to calculate the ArchiveSummary of a year's validated rows,
+    added to the summary of the rows of the year already archived, if any.
+    """
+    if previous is None:
+        previous = storage.ArchiveSummary(
+            year, 0, rows[0][0], None, 0.0, 0.0, None, None, ""
+            )
+    return storage.ArchiveSummary(
+        year,
+        previous.refuels + len(rows),
+        previous.first_odo,
+        rows[-1][0],
+        round(previous.fuel_quantity + sum(row[1] for row in rows), 2),
+        round(previous.fuel_cost + sum(row[2] for row in rows), 2),
+        *rows[-1][1:],
+        )
+
+
+def archived_count(rows, summaries):
+    """
+    Function to count the leading rows of the ledger already archived, by a
+    run that failed before deleting them.
+    They are the rows up to the last archived refuel, matched on its whole
+    row, as a refuel of the same reading may follow it in the ledger.
+    Returns 0 if the last archived refuel is not in the ledger.
+    """
+    last_row = previous_row(summaries)
+    if last_row is None:
+        return 0
+    for index, row in enumerate(rows):
+        try:
+            values = (int(row[0]), float(row[1]), float(row[2]), row[3])
+        except ValueError:
+            return 0
+        if values == last_row:
+            return index + 1
+        if values[0] > last_row[0]:
+            return 0
+    return 0
+
+
+def read_archived_rows(ledger, summaries):
+    """
+    Function to read the refuels of every archived year of a ledger, with
+    a single storage call, so ranges and trends can span closed years.
+    Returns them as validated (odo, quantity, cost, date) rows, in order.
+    Raises a ValueError if an archive does not match its summary.
+    """
+    archives = ledger.read_archive_rows(
+        [summary.year for summary in summaries]
+        )
+    rows = []
+    for summary in summaries:
+        year_rows = [
+            list(row[:4]) + [""] * (4 - len(row))
+            for row in archives.get(summary.year, [])
+            ]
+        if len(year_rows) != summary.refuels:
+            raise ValueError(
+                f"The archive of {summary.year} does not match its summary."
+                )
+        rows.extend(year_rows)
+    valid_rows, issues = validation.validate_ledger(enumerate(rows))
+    if any(not issue.warning for issue in issues):
+        raise ValueError("The archived refuels are invalid.")
+    return valid_rows
+
+
+def archive_closed_years(ledger, today=None):
+    """
+    Function to move the refuels of closed years from the ledger to the
+    archive of each year.
+    The archives are written first, with their summary rows, then the
+    archived rows are deleted from the ledger, with the rows a failed run
+    already archived.
+    Runs under a file lock, and re-reads the ledger once it holds it, so a
+    year is archived by a single process.
+    Returns the number of refuels deleted from the ledger, or 0 if the
+    ledger is invalid, including readings lower than the archived ones.
+    """
+    lock_path = ledger_cache.cache_path(ledger.vehicle)
+    with locks.file_lock(lock_path):
+        archived_years = ledger.read_summaries()
+        rows = [
+            list(row[:4]) + [""] * (4 - len(row))
+            for row in ledger.read_rows()
+            ]
+        skipped = archived_count(rows, archived_years)
+        rows = rows[skipped:]
+        valid_rows, issues = validation.validate_ledger(
+            enumerate(rows, start=skipped + 2), previous_row(archived_years)
+            )
+        if any(not issue.warning for issue in issues):
+            return 0
+        groups = closed_years(valid_rows, today)
+        if not groups and not skipped:
+            return 0
+
+        summaries = {summary.year: summary for summary in archived_years}
+        for year, indexes in groups:
+            ledger.archive_rows(
+                year,
+                [rows[index] for index in indexes],
+                summarise(
+                    year, [valid_rows[index] for index in indexes],
+                    summaries.get(year)
+                    ),
+                )
+        archived = skipped + (groups[-1][1][-1] + 1 if groups else 0)
+        ledger.delete_rows(archived)
+        return archived
@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import storage
+
+
+# Worker threads running the blocking storage calls. There are as many as
+# pooled HTTP connections, so every concurrent request keeps its connection
+# alive between calls.
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=storage.POOL_SIZE, thread_name_prefix="storage"
+    )
+
+
+class AsyncStorage:
+    """
+    Asyncio interface to a storage backend instance.
+    gspread has no asynchronous transport, so each call runs on the shared
+    worker pool while the event loop awaits it. Independent calls started
+    together therefore take as long as the slowest of them.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+
+    async def read_rows(self, start=0):
+        """Returns the ledger rows from the given 0-based offset."""
+        return await run_blocking(self.ledger.read_rows, start)
+
+    async def read_summaries(self):
+        """Returns the ArchiveSummary of each archived year, by year."""
+        return await run_blocking(self.ledger.read_summaries)
+
+    async def append_row(self, row):
+        """Appends one ledger row."""
+        await run_blocking(self.ledger.append_row, row)
+
+    async def append_rows(self, rows):
+        """Appends several ledger rows."""
+        await run_blocking(self.ledger.append_rows, rows)
+
+
+async def run_blocking(func, *args):
+    """
+    Function to run a blocking storage call on the worker pool.
+    The call runs in a copy of the caller's context, so it is profiled
+    under the caller's screen.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        EXECUTOR, partial(context.run, func, *args)
+        )
+
+
+async def gather_rows(ledgers, start=0):
+    """
+    Function to read several ledgers concurrently.
+    Returns their rows, in the order of the ledgers.
+    """
+    return await asyncio.gather(
+        *(AsyncStorage(ledger).read_rows(start) for ledger in ledgers)
+        )
+
+
+async def gather_ledger(ledger):
+    """
+    Function to read the rows of a ledger and the summaries of its archived
+    years concurrently.
+    Returns the rows and the summaries.
+    """
+    async_ledger = AsyncStorage(ledger)
+    return await asyncio.gather(
+        async_ledger.read_rows(), async_ledger.read_summaries()
+        )
+
+
+async def read_fleet(backend, vehicles):
+    """
+    Function to read the ledgers of several vehicles.
+    Backends with batch reads read them all with one blocking call on the
+    worker pool. The ledgers of the others are read concurrently, awaited
+    here so no worker waits for other workers.
+    Returns a dict of the rows of each vehicle.
+    """
+    if backend.batch_reads:
+        return await run_blocking(backend.read_fleet, vehicles)
+    ledgers = await gather_rows([backend(vehicle) for vehicle in vehicles])
+    return dict(zip(vehicles, ledgers))
+
+
+async def gather_fleet(backend, vehicles):
+    """
+    Function to read the ledgers of several vehicles and the summaries of
+    their archived years concurrently.
+    Returns the dict of the rows and the dict of the summaries of each
+    vehicle.
+    """
+    return await asyncio.gather(
+        read_fleet(backend, vehicles),
+        run_blocking(backend.read_archive_summaries, vehicles)
+        )
@@ -0,0 +1,237 @@
+import argparse
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+
+import archive
+import journal
+import ledger_cache
+import metrics_engine
+import rolling
+import run
+import scheduler
+import storage
+
+
+# Benchmark setup:
+SIZES = [10, 1000, 100000]
+# Synthetic refuels are spread evenly over this many years, ending today.
+HISTORY_YEARS = 20
+HEADER = ["Odometer", "Fuel Quantity", "Fuel Cost", "Date"]
+# Requests per minute allowed by default, high enough not to throttle.
+UNLIMITED = 10 ** 9
+# Directory of the ledger snapshots memory-mapped during the benchmark,
+# removed on exit.
+SNAPSHOT_DIR = tempfile.TemporaryDirectory(prefix="cfm_benchmark_")
+
+
+class FakeWorksheet:
+    """
+    Stand-in for the gspread worksheet of a ledger.
+    Keeps the rows in memory, counts every API call by method and sleeps
+    for the given latency on each one, like a round trip to Google Sheets.
+    Row 1 is the header, the ledger starts on row 2.
+    """
+
+    def __init__(self, rows, latency=0.0, title="benchmark"):
+        self.rows = rows
+        self.latency = latency
+        self.title = title
+        self.calls = Counter()
+
+    def api_call(self, method):
+        """Counts an API call and waits for its latency."""
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, cell_range):
+        """Returns the rows of an A{row}:D range, like worksheet.get()."""
+        self.api_call("get")
+        first_row = int(re.match(r"A(\d+)", cell_range).group(1))
+        rows = [HEADER] + self.rows
+        return [list(row) for row in rows[first_row - 1:]]
+
+    def col_values(self, col):
+        """Returns every value of a 1-based column, header included."""
+        self.api_call("col_values")
+        return [HEADER[col - 1]] + [row[col - 1] for row in self.rows]
+
+    def append_row(self, row):
+        """Appends one row."""
+        self.api_call("append_row")
+        self.rows.append([str(value) for value in row])
+
+    def append_rows(self, rows):
+        """Appends several rows in one call."""
+        self.api_call("append_rows")
+        self.rows.extend([str(value) for value in row] for row in rows)
+
+
+def synthetic_rows(count):
+    """
+    Function to generate a ledger of synthetic refuels as worksheet rows.
+    Odometer readings grow by 300 to 699km, quantities stay under the tank
+    capacity and dates never go backwards.
+    """
+    first_date = date.today() - timedelta(days=365 * HISTORY_YEARS)
+    odo_data = 10000
+    rows = []
+    for row in range(count):
+        odo_data += 300 + row * 37 % 400
+        fuel_quantity = round(20 + row * 13 % 1900 / 100, 2)
+        fuel_cost = round(fuel_quantity * (1.5 + row % 50 / 100), 2)
+        refuel_date = first_date + timedelta(
+            days=row * 365 * HISTORY_YEARS // count
+            )
+        rows.append([
+            str(odo_data), str(fuel_quantity), str(fuel_cost),
+            refuel_date.isoformat()
+            ])
+    return rows
+
+
+def open_benchmark_ledger(worksheet):
+    """
+    Function to point run.py at a Sheets ledger backed by the fake
+    worksheet, with an empty in-memory ledger cache, journal and metrics
+    accumulators, and no ledger snapshot yet.
+    """
+    ledger = storage.SheetsStorage(vehicle=worksheet.title)
+    # The worksheet is a cached property, so setting it skips authorising.
+    ledger.__dict__["worksheet"] = worksheet
+    # The whole history stays in the fake worksheet, with no archived years.
+    ledger.read_summaries = list
+    run.STORAGE = ledger
+    run.CACHE = ledger_cache.open_cache(ledger.source, ":memory:")
+    run.SNAPSHOT_PATH = os.path.join(SNAPSHOT_DIR.name, "snapshot.bin")
+    if os.path.exists(run.SNAPSHOT_PATH):
+        os.remove(run.SNAPSHOT_PATH)
+    run.JOURNAL = journal.Journal(ledger, background=False)
+    run.ENGINE = metrics_engine.MetricsEngine(
+        generation=ledger_cache.cache_generation(run.CACHE)
+        )
+    run.ROLLING = rolling.RollingMetrics(
+        ledger_cache.cache_generation(run.CACHE)
+        )
+
+
+def measure(worksheet, operation, reset=None):
+    """
+    Function to run one operation with its screen output silenced.
+    Returns its wall time in seconds, its API calls and its peak memory in
+    bytes, traced in a separate run so tracing does not skew the time.
+    Calls reset, if given, before each run.
+    """
+    if reset:
+        reset()
+    before = sum(worksheet.calls.values())
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        operation()
+    wall_time = time.perf_counter() - start
+    api_calls = sum(worksheet.calls.values()) - before
+
+    if reset:
+        reset()
+    tracemalloc.start()
+    with redirect_stdout(io.StringIO()):
+        operation()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return wall_time, api_calls, peak_memory
+
+
+def benchmark(count, latency):
+    """
+    Function to benchmark the app over a ledger of count refuels.
+    Each operation is measured on an empty ledger cache (cold), as on the
+    first view after starting the app, then on the synced cache (warm).
+    The upload path is measured up to the refuel being journaled, then
+    including its upload.
+    Returns a list of (operation, wall time, API calls, peak memory).
+    """
+    rows = synthetic_rows(count)
+    next_odo = int(rows[-1][0]) + 500 if rows else 10000
+    operations = [
+        ("latest_metrics", run.latest_metrics),
+        ("total_ownership_metrics", run.total_ownership_metrics),
+        ("validate_odo_input", lambda: run.validate_odo_input(str(next_odo))),
+        ]
+    results = []
+    for name, operation in operations:
+        worksheet = FakeWorksheet(list(rows), latency)
+        results.append((f"{name} (cold)",) + measure(
+            worksheet, operation, lambda: open_benchmark_ledger(worksheet)
+            ))
+        results.append((f"{name} (warm)",) + measure(worksheet, operation))
+
+    worksheet = FakeWorksheet(list(rows), latency)
+    open_benchmark_ledger(worksheet)
+    run.sync_data(require_data=False)
+    uploads = iter(range(next_odo, next_odo + 4000, 500))
+
+    def upload():
+        run.upload_data([
+            str(next(uploads)), "30.0", "55.5", date.today().isoformat()
+            ])
+
+    # The user waits for the journal only, the flusher uploads afterwards.
+    results.append(("upload_data",) + measure(worksheet, upload))
+    results.append(("upload_data + flush",) + measure(
+        worksheet, lambda: (upload(), run.JOURNAL.flush())
+        ))
+    return results
+
+
+def main(argv=None):
+    """
+    Command line entry point printing the benchmark of each ledger size:
+    python3 benchmark.py --sizes 10 1000 1000000 --latency 0.2
+    """
+    parser = argparse.ArgumentParser(description="Car Fuel Metrics benchmark")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES,
+        help="numbers of synthetic refuels (default: %(default)s)"
+        )
+    parser.add_argument(
+        "--latency", type=float, default=0.0,
+        help="seconds added to each API call (default: %(default)s)"
+        )
+    parser.add_argument(
+        "--reads-per-minute", type=int, default=UNLIMITED,
+        help="read quota of the request scheduler (default: unlimited)"
+        )
+    parser.add_argument(
+        "--writes-per-minute", type=int, default=UNLIMITED,
+        help="write quota of the request scheduler (default: unlimited)"
+        )
+    args = parser.parse_args(argv)
+
+    scheduler.SHEETS = scheduler.Scheduler(
+        args.reads_per_minute, args.writes_per_minute
+        )
+    # The synthetic history spans closed years, which are kept in the live
+    # ledger to measure its full length.
+    archive.ENABLED = False
+    print(f"API call latency: {args.latency}s")
+    for count in args.sizes:
+        print(f"\n{count} refuels:")
+        print(f"{'Operation':<32}{'Wall time':>12}{'API calls':>11}"
+              f"{'Peak memory':>14}")
+        for name, wall_time, api_calls, peak_memory in benchmark(
+                count, args.latency):
+            print(f"{name:<32}{wall_time * 1000:>10.1f}ms{api_calls:>11}"
+                  f"{peak_memory / 1024:>12.1f}KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
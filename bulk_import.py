@@ -0,0 +1,185 @@
+import argparse
+import csv
+import json
+import sys
+from contextlib import closing
+from datetime import date
+
+import archive
+import ledger_cache
+import storage
+import validation
+
+
+# Bulk import setup:
+CHUNK_SIZE = 500  # Rows written per append_rows() API call.
+
+# Accepted column names for each ledger field, in ledger column order.
+FIELD_NAMES = [
+    ("odo", "odometer", "odometer_reading"),
+    ("quantity", "fuel_quantity", "litres"),
+    ("cost", "fuel_cost", "eur"),
+    ("date", "refuel_date"),
+    ]
+
+
+def read_refuels(path):
+    """
+    Function to stream refuels from a CSV or JSONL file.
+    JSONL files hold one object per line with odometer, quantity, cost and
+    optional date fields. CSV files hold the columns in ledger order, with
+    an optional header row naming them.
+    Yields (line number, [odo, quantity, cost, date]) with the values as
+    strings.
+    """
+    # utf-8-sig skips the byte order mark of Excel's CSV UTF-8 files.
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for line_number, line in enumerate(file, start=1):
+                if line.strip():
+                    yield line_number, _json_row(line)
+            return
+
+        header = None
+        for line_number, row in enumerate(csv.reader(file), start=1):
+            if not row or not "".join(row).strip():
+                continue
+            if line_number == 1 and not row[0].strip().isdigit():
+                header = [name.strip().lower() for name in row]
+                continue
+            yield line_number, _csv_row(row, header)
+
+
+def validate_refuels(refuels, previous=None, today=None):
+    """
+    Function to validate streamed refuels in a single pass.
+    Applies the ledger rules of validation.validate_ledger(), including
+    odometer readings and dates that must not go backwards from one row to
+    the next, carrying on from the last refuel already stored, and dates
+    that must not be after today, if given.
+    Returns the valid rows as read, and the RowIssues of every offending
+    line.
+    """
+    refuels = list(refuels)
+    _, issues = validation.validate_ledger(refuels, previous, today)
+    invalid_lines = {issue.row for issue in issues if not issue.warning}
+    rows = [row for line_number, row in refuels
+            if line_number not in invalid_lines]
+    return rows, issues
+
+
+def last_refuel(backend):
+    """
+    Function to find the last refuel stored in a ledger, validated, to
+    carry the checks on from.
+    Only the rows added since the ledger cache was last synced are read,
+    or the whole ledger if it is not cached.
+    Returns the last refuel, or the last archived one once the ledger is
+    archived, or None.
+    """
+    path = (
+        ledger_cache.cache_path(backend.vehicle) if backend.persistent
+        else ":memory:"
+        )
+    with closing(ledger_cache.open_cache(backend.source, path)) as conn:
+        new_rows = ledger_cache.fetch_new_rows(conn, backend)
+        if new_rows:
+            stored, _ = validation.validate_ledger(enumerate(new_rows[-1:]))
+            return stored[-1] if stored else None
+        previous = ledger_cache.last_cached_row(conn)
+    if previous is None:
+        previous = archive.previous_row(backend.read_summaries())
+    return previous
+
+
+def import_refuels(path, backend, chunk_size=CHUNK_SIZE):
+    """
+    Function to import a file of historical refuels into the storage.
+    Validates every row before writing anything, carried on from the last
+    stored refuel and with no dates in the future, and prints every offending
+    line if any row is invalid, so the file can be fixed in one go.
+    Unusual values, such as price outliers, are listed as warnings but
+    imported.
+    Writes the rows with one append_rows() call per chunk.
+    Returns the number of rows imported.
+    """
+    rows, issues = validate_refuels(
+        read_refuels(path), last_refuel(backend), date.today()
+        )
+
+    for issue in issues:
+        if issue.warning:
+            print(f"Line {issue.row}, warning: {issue.message}")
+    errors = [issue for issue in issues if not issue.warning]
+    if errors:
+        invalid_lines = len({issue.row for issue in errors})
+        print(f"{invalid_lines} invalid rows found, nothing was imported:")
+        for issue in errors:
+            print(f"Line {issue.row}, {issue.column}: {issue.message}")
+        return 0
+
+    for start in range(0, len(rows), chunk_size):
+        backend.append_rows(rows[start:start + chunk_size])
+        print(f"Uploaded {min(start + chunk_size, len(rows))}/{len(rows)}")
+    print(f"{len(rows)} refuels imported successfully.")
+    return len(rows)
+
+
+def _json_row(line):
+    """Returns the ledger values of a JSONL line as strings."""
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return ["", "", "", ""]
+    if not isinstance(record, dict):
+        return ["", "", "", ""]
+    record = {str(key).lower(): value for key, value in record.items()}
+    return [
+        _string(next((record[name] for name in names if name in record), ""))
+        for names in FIELD_NAMES
+        ]
+
+
+def _csv_row(row, header):
+    """Returns the ledger values of a CSV row as strings."""
+    if header is None:
+        values = row[:4]
+    else:
+        record = dict(zip(header, row))
+        values = [
+            next((record[name] for name in names if name in record), "")
+            for names in FIELD_NAMES
+            ]
+    values = [value.strip() for value in values]
+    return values + [""] * (4 - len(values))
+
+
+def _string(value):
+    """Converts a JSON value to the string form typed into the app."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def main(argv=None):
+    """
+    Command line entry point:
+    python3 bulk_import.py refuels.csv
+    """
+    parser = argparse.ArgumentParser(
+        description="Import historical refuels from a CSV or JSONL file."
+        )
+    parser.add_argument("path", help="CSV or JSONL file of refuels")
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE,
+        help="rows written per API call"
+        )
+    args = parser.parse_args(argv)
+    imported = import_refuels(
+        args.path, storage.get_storage(), args.chunk_size
+        )
+    return 0 if imported else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import argparse
+import json
+import sys
+from contextlib import redirect_stdout
+from datetime import date
+
+import archive
+import bulk_import
+import fleet
+import instrumentation
+import ledger_cache
+import ledger_index
+import metrics_engine
+import run
+import storage
+import validation
+
+
+METRIC_SETS = ["latest", "annual", "range", "total", "rolling"]
+# Range metrics need their bounds, so "all" covers the other metric sets.
+ALL_METRICS = ["latest", "annual", "total", "rolling"]
+
+
+def latest_metrics():
+    """Returns the latest refueling metrics of the open ledger."""
+    results = run.load_metrics()
+    if results is None or results["latest_trip_distance"] is None:
+        raise ValueError("Not enough data available.")
+    return metrics_engine.metric_set(results, metrics_engine.LATEST_METRICS)
+
+
+def total_metrics():
+    """Returns the total ownership metrics of the open ledger."""
+    results = run.load_metrics()
+    if results is None or not results["total_trip_distance"]:
+        raise ValueError("Not enough data available.")
+    return metrics_engine.metric_set(results, metrics_engine.TOTAL_METRICS)
+
+
+def annual_metrics(year=None):
+    """
+    Returns the metrics of every year of the open ledger, or of the given
+    year only.
+    """
+    fuel_data = run.validate_data()
+    if fuel_data is None:
+        raise ValueError("Not enough data available.")
+    year_index = ledger_index.YearIndex(
+        fuel_data, ledger_cache.read_summaries(run.CACHE)
+        )
+    years = year_index.years() if year is None else [year]
+    return {
+        str(item): year_index.year_metrics(item)._asdict()
+        for item in years if item in year_index.years()
+        }
+
+
+def range_metrics(args):
+    """
+    Returns the metrics of the open ledger, including its archived years,
+    between the odometer readings or dates given on the command line.
+    """
+    fuel_data = run.validate_data()
+    if fuel_data is None:
+        raise ValueError("Not enough data available.")
+    range_index = ledger_index.RangeIndex(ledger_index.with_archive(
+        fuel_data, ledger_cache.archived_rows(run.CACHE)
+        ))
+    if args.from_odo is not None and args.to_odo is not None:
+        metrics = range_index.odo_range_metrics(args.from_odo, args.to_odo)
+    elif args.from_date and args.to_date:
+        metrics = range_index.date_range_metrics(args.from_date, args.to_date)
+    else:
+        raise ValueError(
+            "Range metrics need --from-odo and --to-odo, "
+            "or --from-date and --to-date."
+            )
+    return metrics._asdict() if metrics else None
+
+
+def rolling_metrics():
+    """Returns the metrics of the last refuels and last days windows."""
+    trends = run.load_rolling_metrics()
+    if trends is None:
+        raise ValueError("Not enough data available.")
+    return {
+        name: metrics._asdict() if metrics else None
+        for name, metrics in trends.results().items()
+        }
+
+
+def vehicle_metrics(vehicle, args):
+    """
+    Function to calculate the selected metric set of one vehicle.
+    Returns a dict of the metrics, or of the error that stopped them.
+    """
+    run.open_ledger(vehicle)
+    result = {"vehicle": vehicle}
+    selected = ALL_METRICS if args.metric_set == "all" else [
+        args.metric_set
+        ]
+    try:
+        for metric_set in selected:
+            if metric_set == "latest":
+                result["latest"] = latest_metrics()
+            elif metric_set == "annual":
+                result["annual"] = annual_metrics(args.year)
+            elif metric_set == "range":
+                result["range"] = range_metrics(args)
+            elif metric_set == "rolling":
+                result["rolling"] = rolling_metrics()
+            else:
+                result["total"] = total_metrics()
+    except ValueError as e:
+        result["error"] = str(e)
+    return result
+
+
+def add_refuels(vehicle, refuels):
+    """
+    Function to validate and append refuels given as
+    ODO,QUANTITY,COST[,DATE] strings.
+    Validates them like the rows of the ledger, carried on from its last
+    refuel, including the pending ones, so readings and dates never go
+    backwards. Dates must not be in the future.
+    Then saves every refuel to the journal and uploads them with a single
+    storage call.
+    Returns a dict of the number of refuels added and of those left pending
+    in the journal, or of the error.
+    """
+    run.open_ledger(vehicle)
+    if not run.sync_data(require_data=False):
+        return {"vehicle": vehicle, "error": "Unable to read the ledger."}
+    today = date.today()
+    rows = []
+    for refuel in refuels:
+        values = [value.strip() for value in refuel.split(",")]
+        if len(values) == 3:
+            values.append(today.isoformat())
+        if len(values) != 4:
+            error = "Refuels must be ODO,QUANTITY,COST[,DATE]."
+        else:
+            error = validation.date_error(values[3], today)
+        if error:
+            return {"vehicle": vehicle, "refuel": refuel, "error": error}
+        rows.append(values)
+    _, issues = validation.validate_ledger(
+        enumerate(rows), run.last_refuel()
+        )
+    errors = [issue for issue in issues if not issue.warning]
+    if errors:
+        return {
+            "vehicle": vehicle, "refuel": refuels[errors[0].row],
+            "error": errors[0].message,
+            }
+    run.save_refuels(rows)
+    run.JOURNAL.try_flush()
+    return {
+        "vehicle": vehicle,
+        "added": len(rows),
+        "pending": len(run.JOURNAL.pending_rows()),
+        }
+
+
+def check_ledger(vehicle):
+    """
+    Function to validate a vehicle's whole ledger in a single pass, carried
+    on from its last archived year.
+    Returns a dict of every invalid value and warning, by worksheet row.
+    """
+    ledger = storage.get_storage(vehicle=vehicle)
+    rows = ledger.read_rows()
+    _, issues = validation.validate_ledger(
+        enumerate(rows, start=2), archive.previous_row(ledger.read_summaries())
+        )
+    return {
+        "vehicle": vehicle,
+        "rows": len(rows),
+        "errors": [
+            issue._asdict() for issue in issues if not issue.warning
+            ],
+        "warnings": [issue._asdict() for issue in issues if issue.warning],
+        }
+
+
+def selected_vehicles(args):
+    """Returns the vehicles selected on the command line."""
+    if args.all_vehicles:
+        return storage.get_backend().list_vehicles()
+    return args.vehicle or [storage.VEHICLE]
+
+
+def build_parser():
+    """Returns the argument parser of the command line interface."""
+    parser = argparse.ArgumentParser(
+        description="Car Fuel Metrics command line interface. "
+        "Prints its results as JSON."
+        )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="dump the storage call profile to stderr"
+        )
+    parser.add_argument(
+        "--profile-file", metavar="FILE",
+        help="export the storage call profile as JSON to FILE"
+        )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    metrics = subparsers.add_parser("metrics", help="calculate metrics")
+    metrics.add_argument("metric_set", choices=METRIC_SETS + ["all"])
+    metrics.add_argument("--year", type=int, help="year of annual metrics")
+    metrics.add_argument("--from-odo", type=int)
+    metrics.add_argument("--to-odo", type=int)
+    metrics.add_argument("--from-date", help="YYYY-MM-DD")
+    metrics.add_argument("--to-date", help="YYYY-MM-DD")
+
+    add = subparsers.add_parser("add", help="append refuels")
+    add.add_argument(
+        "refuels", nargs="+", metavar="ODO,QUANTITY,COST[,DATE]"
+        )
+
+    import_parser = subparsers.add_parser(
+        "import", help="import refuels from a CSV or JSONL file"
+        )
+    import_parser.add_argument("path")
+
+    check = subparsers.add_parser(
+        "check", help="report every invalid row of the ledger"
+        )
+
+    subparsers.add_parser("fleet", help="rank the vehicles of the fleet")
+    subparsers.add_parser("vehicles", help="list the vehicles")
+
+    for subparser in (metrics, add, import_parser, check):
+        group = subparser.add_mutually_exclusive_group()
+        group.add_argument(
+            "--vehicle", action="append",
+            help="vehicle to use, can be repeated (default: CFM_VEHICLE)"
+            )
+        group.add_argument(
+            "--all-vehicles", action="store_true",
+            help="use every vehicle of the fleet"
+            )
+    return parser
+
+
+def main(argv=None):
+    """
+    Command line entry point, for example:
+    python3 cli.py metrics total --vehicle van --vehicle car
+    python3 cli.py add 123456,23.45,45.67
+    Human readable messages go to stderr, so stdout only holds the JSON.
+    """
+    args = build_parser().parse_args(argv)
+    instrumentation.set_screen(args.command)
+    with redirect_stdout(sys.stderr):
+        if args.command == "metrics":
+            result = [
+                vehicle_metrics(vehicle, args)
+                for vehicle in selected_vehicles(args)
+                ]
+        elif args.command == "add":
+            result = [
+                add_refuels(vehicle, args.refuels)
+                for vehicle in selected_vehicles(args)
+                ]
+        elif args.command == "import":
+            result = [
+                {
+                    "vehicle": vehicle,
+                    "imported": bulk_import.import_refuels(
+                        args.path, storage.get_storage(vehicle=vehicle)
+                        ),
+                }
+                for vehicle in selected_vehicles(args)
+                ]
+        elif args.command == "check":
+            result = [
+                check_ledger(vehicle) for vehicle in selected_vehicles(args)
+                ]
+        elif args.command == "fleet":
+            summaries, skipped = fleet.fleet_summary()
+            result = {
+                "ranking": [summary._asdict() for summary in summaries],
+                "not_enough_data": skipped,
+            }
+        else:
+            result = storage.get_backend().list_vehicles()
+        if args.profile or args.profile_file:
+            instrumentation.dump_profile(args.profile_file)
+
+    print(json.dumps(result, indent=2))
+    failed = isinstance(result, list) and any(
+        isinstance(item, dict)
+        and ("error" in item or item.get("imported") == 0
+             or item.get("errors"))
+        for item in result
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
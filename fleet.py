@@ -0,0 +1,85 @@
+import asyncio
+from collections import namedtuple
+
+import archive
+import async_storage
+import metrics_engine
+import numpy_metrics
+import storage
+import validation
+
+
+# Total ownership metrics of one vehicle of the fleet.
+VehicleSummary = namedtuple(
+    "VehicleSummary",
+    ["vehicle", "refuels", "distance", "fuel_quantity", "fuel_cost",
+     "gas_mileage", "fuel_price", "cost_per_100km"]
+    )
+
+
+def summarise_vehicle(vehicle, rows, summaries=()):
+    """
+    Function to calculate the total ownership metrics of one vehicle with
+    the metrics engine, or with the NumPy engine if selected, from its live
+    rows and the summaries of its archived years.
+    The rows are validated like everywhere else in the app, carrying on
+    from the last archived refuel.
+    Returns a VehicleSummary, or None if the ledger is invalid or has fewer
+    than two refuels.
+    """
+    previous = archive.previous_row(summaries)
+    if (numpy_metrics.enabled()
+            and numpy_metrics.validate_rows(rows, previous) is not None):
+        columns = numpy_metrics.parse_columns(rows)
+        results = numpy_metrics.calculate_metrics(*columns, summaries)
+    else:
+        refuels, issues = validation.validate_ledger(
+            enumerate(rows, start=2), previous
+            )
+        if any(not issue.warning for issue in issues):
+            return None
+        results = metrics_engine.calculate_metrics(
+            refuels, metrics_engine.TOTAL_METRICS.values(), summaries
+            )
+    refuel_count = len(rows) + sum(item.refuels for item in summaries)
+    distance = results["total_trip_distance"]
+    if refuel_count < 2 or not distance or distance <= 0:
+        return None
+    return VehicleSummary(
+        vehicle,
+        refuel_count,
+        distance,
+        results["total_fuel_quantity"],
+        results["total_fuel_cost"],
+        results["average_gas_mileage"],
+        results["average_fuel_price"],
+        metrics_engine.ratio(results["total_fuel_cost"], distance, 100),
+        )
+
+
+def fleet_summary(backend=None, vehicles=None):
+    """
+    Function to summarise every vehicle of the fleet.
+    Reads all the ledgers at once with the backend's read_fleet(), which
+    batches or parallelises the reads, while the summaries of all their
+    archived years are read at once alongside.
+    Returns the summaries ranked by gas mileage, then by cost per 100km,
+    and the names of the vehicles without enough valid data.
+    """
+    backend = backend or storage.get_backend()
+    if vehicles is None:
+        vehicles = backend.list_vehicles()
+    ledgers, archives = asyncio.run(
+        async_storage.gather_fleet(backend, list(vehicles))
+        )
+
+    summaries = []
+    skipped = []
+    for vehicle, rows in ledgers.items():
+        summary = summarise_vehicle(vehicle, rows, archives[vehicle])
+        if summary is None:
+            skipped.append(vehicle)
+        else:
+            summaries.append(summary)
+    summaries.sort(key=lambda item: (item.gas_mileage, item.cost_per_100km))
+    return summaries, skipped
@@ -0,0 +1,240 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque, namedtuple
+from contextvars import ContextVar
+from functools import wraps
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds. Slower
+# calls fall in the last, unbounded bucket.
+LATENCY_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+# Most recent calls kept for the profile export.
+MAX_RECORDS = 10000
+# Storage methods recorded by every backend.
+TRACED_METHODS = [
+    "read_rows", "append_row", "append_rows", "list_vehicles", "read_fleet",
+    "archive_rows", "delete_rows", "read_archive_summaries",
+    "read_archive_rows"
+    ]
+
+# Screen, command or endpoint the storage calls are made for.
+CURRENT_SCREEN = ContextVar("CURRENT_SCREEN", default=None)
+
+# One storage call, or one attempt of a Google Sheets API request, with
+# its HTTP status and the number of the attempt, 0 for the first one.
+CallRecord = namedtuple(
+    "CallRecord",
+    ["screen", "op", "worksheet", "cell_range", "rows", "latency", "error",
+     "status", "attempt"],
+    defaults=(None, 0)
+    )
+# Prefix of the operations of API requests in the profile, to tell them
+# from the storage calls making them.
+API_PREFIX = "api:"
+
+
+class Session:
+    """
+    Profile of the storage calls made by this process.
+    Keeps counters and latency histograms per screen and operation, and
+    the most recent calls. Calls may be recorded from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.records = deque(maxlen=MAX_RECORDS)
+        self.counters = defaultdict(Counter)
+        self.histograms = defaultdict(
+            lambda: [0] * (len(LATENCY_BUCKETS) + 1)
+            )
+
+    def record(self, call):
+        """Adds a CallRecord to the profile."""
+        key = (call.screen, call.op)
+        bucket = bisect_left(LATENCY_BUCKETS, call.latency * 1000)
+        with self.lock:
+            self.records.append(call)
+            counters = self.counters[key]
+            counters["calls"] += 1
+            counters["rows"] += call.rows
+            counters["errors"] += call.error is not None
+            counters["retries"] += call.attempt > 0
+            if call.status is not None:
+                counters[f"status_{call.status}"] += 1
+            counters["latency"] += call.latency
+            self.histograms[call.op][bucket] += 1
+
+    def summary(self):
+        """Returns the profile as a dict ready to be dumped as JSON."""
+        with self.lock:
+            return {
+                "started": self.started,
+                "counters": [
+                    {"screen": screen, "op": op, **counters}
+                    for (screen, op), counters in self.counters.items()
+                    ],
+                "histograms": {
+                    op: dict(zip(bucket_labels(), counts))
+                    for op, counts in self.histograms.items()
+                    },
+                "calls": [call._asdict() for call in self.records],
+            }
+
+    def report(self):
+        """Returns the counters and histograms as printable text."""
+        lines = [
+            "Storage calls by screen:",
+            f"{'Screen':<26}{'Operation':<24}{'Calls':>6}{'Rows':>9}"
+            f"{'Errors':>7}{'Retries':>8}{'Mean':>10}",
+            ]
+        with self.lock:
+            for (screen, op), counters in sorted(
+                    self.counters.items(), key=lambda item: str(item[0])):
+                mean = counters["latency"] / counters["calls"] * 1000
+                lines.append(
+                    f"{screen or '-':<26}{op:<24}{counters['calls']:>6}"
+                    f"{counters['rows']:>9}{counters['errors']:>7}"
+                    f"{counters['retries']:>8}{mean:>8.1f}ms"
+                    )
+            lines.append("\nLatency histograms:")
+            for op, counts in sorted(self.histograms.items()):
+                buckets = ", ".join(
+                    f"{label}: {count}"
+                    for label, count in zip(bucket_labels(), counts) if count
+                    )
+                lines.append(f"{op}: {buckets}")
+            errors = [call for call in self.records if call.error]
+        if errors:
+            lines.append("\nErrors:")
+            lines.extend(
+                f"{call.screen or '-'} {call.op} {call.worksheet}: "
+                f"{call.error}"
+                + (f" (HTTP {call.status})" if call.status else "")
+                for call in errors
+                )
+        return "\n".join(lines)
+
+
+# Profile of this process.
+SESSION = Session()
+
+
+def bucket_labels():
+    """Returns the labels of the latency histogram buckets."""
+    return [f"<={bound}ms" for bound in LATENCY_BUCKETS] + [
+        f">{LATENCY_BUCKETS[-1]}ms"
+        ]
+
+
+def set_screen(name):
+    """Sets the screen, command or endpoint of the next storage calls."""
+    CURRENT_SCREEN.set(name)
+
+
+def describe_call(op, ledger, args, kwargs, result):
+    """
+    Function to describe a storage call for its record.
+    Returns the worksheet, the range in worksheet notation and the number
+    of rows read or written.
+    """
+    if op == "read_rows":
+        start = args[0] if args else kwargs.get("start", 0)
+        return ledger.vehicle, f"A{start + 2}:D", len(result or [])
+    elif op == "append_row":
+        return ledger.vehicle, "A:D", 1
+    elif op == "append_rows":
+        return ledger.vehicle, "A:D", len(args[0] if args else kwargs["rows"])
+    elif op == "read_fleet":
+        vehicles = args[0] if args else kwargs["vehicles"]
+        rows = sum(len(rows) for rows in (result or {}).values())
+        return ",".join(vehicles), "A2:D", rows
+    elif op == "archive_rows":
+        year, rows = args[:2] if args else (kwargs["year"], kwargs["rows"])
+        return f"{ledger.vehicle} archive {year}", "A:D", len(rows)
+    elif op == "delete_rows":
+        count = args[0] if args else kwargs["count"]
+        return ledger.vehicle, f"A2:D{count + 1}", count
+    elif op == "read_archive_summaries":
+        vehicles = args[0] if args else kwargs["vehicles"]
+        rows = sum(len(rows) for rows in (result or {}).values())
+        return ",".join(vehicles), "F2:M2", rows
+    elif op == "read_archive_rows":
+        years = args[0] if args else kwargs["years"]
+        rows = sum(len(rows) for rows in (result or {}).values())
+        return (
+            ",".join(f"{ledger.vehicle} archive {year}" for year in years),
+            "A2:D", rows
+            )
+    return None, None, len(result or [])
+
+
+def record_request(op, target, cell_range, latency, attempt, status,
+                   error=None):
+    """
+    Function to record one attempt of a Google Sheets API request in the
+    session profile, with its HTTP status, so retries and quota errors show
+    up under the screen that made them.
+    """
+    SESSION.record(CallRecord(
+        CURRENT_SCREEN.get(), API_PREFIX + op, target, cell_range, 0,
+        latency, error and f"{type(error).__name__}: {error}", status,
+        attempt
+        ))
+
+
+def traced(op, method):
+    """
+    Function to wrap a storage method so each call is recorded in the
+    session profile, with its latency and any error it raised.
+    """
+    @wraps(method)
+    def wrapper(ledger, *args, **kwargs):
+        start = time.perf_counter()
+        result = error = None
+        try:
+            result = method(ledger, *args, **kwargs)
+            return result
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            worksheet, cell_range, rows = describe_call(
+                op, ledger, args, kwargs, result
+                )
+            SESSION.record(CallRecord(
+                CURRENT_SCREEN.get(), op, worksheet, cell_range, rows,
+                latency, error
+                ))
+    return wrapper
+
+
+def trace_storage(cls):
+    """
+    Function to record the storage methods defined by a backend class.
+    Inherited methods are already recorded by the class defining them, so
+    a call is never counted twice.
+    """
+    for op in TRACED_METHODS:
+        attribute = cls.__dict__.get(op)
+        if isinstance(attribute, classmethod):
+            setattr(cls, op, classmethod(traced(op, attribute.__func__)))
+        elif callable(attribute):
+            setattr(cls, op, traced(op, attribute))
+
+
+def dump_profile(path=None):
+    """
+    Function to output the session profile.
+    Prints the counters and histograms, or exports the full profile, with
+    the recorded calls, as JSON to the given file.
+    """
+    if path is None:
+        print(SESSION.report())
+    else:
+        with open(path, "w") as profile_file:
+            json.dump(SESSION.summary(), profile_file, indent=2)
+        print(f"Storage profile exported to {path}.")
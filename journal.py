@@ -0,0 +1,355 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import instrumentation
+import locks
+
+
+# Write-behind journal setup:
+JOURNAL_FILE = os.environ.get("CFM_JOURNAL_FILE", "fuel_journal.jsonl")
+# Most refuels uploaded per append_rows call.
+BATCH_SIZE = 500
+# Seconds the flusher waits after a failed upload, doubling after each
+# failure up to MAX_RETRY_DELAY.
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 300.0
+
+# Open journals, one per journal file, shared by every ledger of a process.
+JOURNALS = {}
+JOURNALS_LOCK = threading.Lock()
+
+
+def journal_path(vehicle):
+    """
+    Returns the journal file of a vehicle's ledger, named after the vehicle
+    next to JOURNAL_FILE.
+    """
+    root, ext = os.path.splitext(JOURNAL_FILE)
+    return f"{root}-{re.sub(r'[^A-Za-z0-9_-]', '_', vehicle)}{ext}"
+
+
+class Journal:
+    """
+    Write-behind queue of the refuels saved to a ledger.
+    Saved refuels are appended to a local journal file and acknowledged at
+    once. A background flusher uploads them in order, in batches of up to
+    BATCH_SIZE rows per append_rows call, and records each uploaded batch
+    in the journal. Refuels still pending when the app stops are uploaded
+    on the next start.
+
+    The journal is a JSON lines file of "add" entries, holding one refuel
+    and the source of its ledger, "send" entries, listing the refuels of a
+    batch about to be uploaded, and "done" entries, listing the refuels
+    uploaded. It is compacted to the pending refuels once they are all
+    uploaded. Without a path, the journal is only kept in memory.
+
+    Every process of a vehicle shares its journal file. The file is read
+    and written under a file lock, and read again before each change, so
+    the pending refuels are those of every process. A single process at a
+    time uploads them, under a second lock held for the whole upload.
+    """
+
+    def __init__(self, storage, path=None, background=True, known_rows=0):
+        self.storage = storage
+        self.path = path
+        # Number of ledger rows already read before the journal was opened.
+        self.known_rows = known_rows
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = {}
+        # Pending entries of other ledgers sharing the journal file.
+        self.other_entries = []
+        # Ids of the last batch sent, but not journaled as uploaded.
+        self.sending = []
+        with self.locked():
+            self.load()
+        self.failures = 0
+        if background:
+            threading.Thread(
+                target=self.run_flusher, name="journal", daemon=True
+                ).start()
+            if self.pending:
+                self.wake.set()
+
+    @contextmanager
+    def locked(self):
+        """
+        Context manager holding the journal lock, and the journal file's
+        lock shared with the other processes.
+        """
+        with self.lock:
+            if not self.path:
+                yield
+                return
+            with locks.file_lock(self.path):
+                yield
+
+    @contextmanager
+    def uploading(self):
+        """
+        Context manager holding the upload lock of the journal, so a single
+        thread of a single process uploads its refuels at a time.
+        """
+        with self.flush_lock:
+            if not self.path:
+                yield
+                return
+            with locks.file_lock(f"{self.path}.upload"):
+                yield
+
+    def load(self):
+        """
+        Function to read the pending refuels of every process back from the
+        journal file, with the last batch sent without being journaled as
+        uploaded, if any.
+        Must be called with the journal locked.
+        """
+        if not self.path:
+            return
+        entries = {}
+        done = set()
+        sent = []
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by a crash while writing.
+                    if entry.get("op") == "add":
+                        entries.setdefault(entry["id"], entry)
+                    elif entry.get("op") == "send":
+                        sent.append(entry)
+                    elif entry.get("op") == "done":
+                        done.update(entry["ids"])
+        self.pending = {}
+        self.other_entries = []
+        for entry_id, entry in entries.items():
+            if entry_id in done:
+                continue
+            elif entry["source"] == self.storage.source:
+                self.pending[entry_id] = entry["row"]
+            else:
+                self.other_entries.append(entry)
+        other_ids = {entry["id"] for entry in self.other_entries}
+        self.sending = []
+        for entry in sent:
+            if any(entry_id in self.pending for entry_id in entry["ids"]):
+                self.sending = [
+                    entry_id for entry_id in entry["ids"]
+                    if entry_id in self.pending
+                    ]
+            elif any(entry_id in other_ids for entry_id in entry["ids"]):
+                self.other_entries.append(entry)
+
+    def write(self, entries):
+        """
+        Appends entries to the journal file and syncs it to disk.
+        Must be called with the journal locked.
+        """
+        if not self.path:
+            return
+        with open(self.path, "a") as journal_file:
+            journal_file.write(
+                "".join(json.dumps(entry) + "\n" for entry in entries)
+                )
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def compact(self):
+        """
+        Function to rewrite the journal file with only its pending entries,
+        replacing it atomically.
+        Must be called with the journal locked, after loading it.
+        """
+        if not self.path:
+            return
+        entries = self.other_entries + [
+            {"op": "add", "id": entry_id, "source": self.storage.source,
+             "row": row}
+            for entry_id, row in self.pending.items()
+            ]
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as journal_file:
+            journal_file.write(
+                "".join(json.dumps(entry) + "\n" for entry in entries)
+                )
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def append(self, rows):
+        """
+        Function to save refuels to the journal.
+        Rows identical to a pending refuel, of any process, are skipped, so
+        confirming the same refuel twice saves it once.
+        Returns once the refuels are on disk, and wakes the flusher.
+        """
+        with self.locked():
+            self.load()
+            pending_rows = {tuple(row) for row in self.pending.values()}
+            entries = []
+            for row in rows:
+                row = [str(value) for value in row]
+                if tuple(row) in pending_rows:
+                    continue
+                pending_rows.add(tuple(row))
+                entries.append({
+                    "op": "add", "id": uuid.uuid4().hex,
+                    "source": self.storage.source, "row": row,
+                    })
+            self.write(entries)
+            for entry in entries:
+                self.pending[entry["id"]] = entry["row"]
+        self.wake.set()
+
+    def pending_rows(self):
+        """
+        Returns the refuels not uploaded yet, saved by any process, in
+        order.
+        """
+        with self.locked():
+            self.load()
+            return list(self.pending.values())
+
+    def last_odo(self):
+        """Returns the odometer reading of the last pending refuel, or None."""
+        rows = self.pending_rows()
+        return int(rows[-1][0]) if rows else None
+
+    def drop_uploaded(self, batch):
+        """
+        Function to drop a batch of refuels already in the ledger.
+        An upload that failed or was cut short by a crash leaves its batch
+        sent but pending, whether it reached the ledger or not. Batches are
+        uploaded one at a time, so it may only be at or after the rows read
+        before. Only that tail of the ledger is read, and searched for the
+        whole batch, comparing every value of its rows, so a genuine refuel
+        at the same odometer reading as the last one is kept.
+        Must be called while uploading.
+        Returns True if the batch was found and dropped.
+        """
+        keys = [_row_key(row) for _, row in batch]
+        tail = [
+            _row_key(row) for row in self.storage.read_rows(
+                max(0, self.known_rows - len(batch))
+                )
+            ]
+        for start in range(len(tail) - len(keys) + 1):
+            if tail[start:start + len(keys)] == keys:
+                with self.locked():
+                    self.load()
+                    self.mark_done([entry_id for entry_id, _ in batch])
+                return True
+        return False
+
+    def mark_done(self, entry_ids):
+        """
+        Function to journal uploaded refuels and remove them from the
+        queue. Compacts the journal once nothing is pending.
+        Must be called with the journal locked, after loading it.
+        """
+        if not entry_ids:
+            return
+        self.write([{"op": "done", "ids": entry_ids}])
+        for entry_id in entry_ids:
+            self.pending.pop(entry_id, None)
+        if not self.pending:
+            self.compact()
+
+    def flush(self):
+        """
+        Function to upload every pending refuel, oldest first, in batches.
+        Each batch is journaled as sent before its upload, so the next
+        upload checks if it reached the ledger when it is still pending.
+        Raises the storage error if a batch could not be uploaded; it stays
+        pending.
+        Returns the number of refuels uploaded.
+        """
+        with self.uploading():
+            uploaded = 0
+            while True:
+                with self.locked():
+                    self.load()
+                    sent = [
+                        (entry_id, self.pending[entry_id])
+                        for entry_id in self.sending
+                        ]
+                    batch = list(self.pending.items())[:BATCH_SIZE]
+                if sent and self.drop_uploaded(sent):
+                    continue
+                if not batch:
+                    return uploaded
+                entry_ids = [entry_id for entry_id, _ in batch]
+                if self.path:
+                    with self.locked():
+                        self.write([{"op": "send", "ids": entry_ids}])
+                self.storage.append_rows([row for _, row in batch])
+                with self.locked():
+                    self.load()
+                    self.mark_done(entry_ids)
+                uploaded += len(batch)
+
+    def try_flush(self):
+        """
+        Function to upload the pending refuels now, leaving any failure to
+        the flusher.
+        Returns True if nothing is left pending.
+        """
+        try:
+            self.flush()
+        except Exception:
+            self.wake.set()
+        return not self.pending_rows()
+
+    def run_flusher(self):
+        """
+        Background flusher, uploading the pending refuels whenever some are
+        saved. After a failure, it retries later with a growing delay.
+        """
+        instrumentation.set_screen("journal_flush")
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.flush()
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                time.sleep(min(
+                    MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (self.failures - 1)
+                    ))
+                self.wake.set()
+
+
+def open_journal(storage, path=None, known_rows=0):
+    """
+    Function to open the write-behind journal of a ledger, given the number
+    of its rows already read, if any.
+    A journal file is opened once per process, and its flusher keeps
+    running after another vehicle is selected.
+    """
+    key = path or f"memory:{storage.source}"
+    with JOURNALS_LOCK:
+        if key not in JOURNALS:
+            JOURNALS[key] = Journal(storage, path, known_rows=known_rows)
+        return JOURNALS[key]
+
+
+def _row_key(row):
+    """
+    Returns the values of a ledger row, with its numbers parsed, to compare
+    rows however their numbers were written.
+    """
+    values = [str(value).strip() for value in row[:4]]
+    values += [""] * (4 - len(values))
+    try:
+        return int(values[0]), float(values[1]), float(values[2]), values[3]
+    except ValueError:
+        return tuple(values)
@@ -0,0 +1,316 @@
+import os
+import re
+import sqlite3
+from collections import namedtuple
+
+import storage
+
+# Local cache setup:
+CACHE_FILE = os.environ.get("CFM_CACHE_FILE", "fuel_cache.sqlite3")
+SCHEMA_VERSION = "5"
+
+# Running totals of the cached ledger, kept up to date on every append.
+Aggregates = namedtuple(
+    "Aggregates",
+    ["row_count", "first_odo", "last_odo", "total_quantity", "total_cost"]
+    )
+
+
+def cache_path(vehicle):
+    """
+    Returns the cache file of a vehicle's ledger, named after the vehicle
+    next to CACHE_FILE.
+    """
+    root, ext = os.path.splitext(CACHE_FILE)
+    return f"{root}-{re.sub(r'[^A-Za-z0-9_-]', '_', vehicle)}{ext}"
+
+
+def open_cache(source, path=CACHE_FILE):
+    """
+    Function to open the local SQLite cache of the fuel ledger.
+    Creates the tables on first use.
+    Empties the cache if it was built for another ledger or an older
+    schema, so the next sync downloads the full ledger again.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+    meta = dict(conn.execute("SELECT key, value FROM meta"))
+    if meta.get("schema") != SCHEMA_VERSION or meta.get("source") != source:
+        conn.execute("DROP TABLE IF EXISTS refuels")
+        conn.execute("DROP TABLE IF EXISTS aggregates")
+        conn.execute("DROP TABLE IF EXISTS archives")
+        conn.execute("DROP TABLE IF EXISTS archived_refuels")
+        conn.execute("DELETE FROM meta")
+        conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [("schema", SCHEMA_VERSION), ("source", source)]
+            )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS refuels ("
+        "row INTEGER PRIMARY KEY, odo INTEGER, quantity REAL, cost REAL, "
+        "date TEXT)"
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS aggregates ("
+        "id INTEGER PRIMARY KEY CHECK (id = 0), row_count INTEGER, "
+        "first_odo INTEGER, last_odo INTEGER, "
+        "total_quantity REAL, total_cost REAL)"
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS archives ("
+        "year INTEGER PRIMARY KEY, refuels INTEGER, first_odo INTEGER, "
+        "last_odo INTEGER, fuel_quantity REAL, fuel_cost REAL, "
+        "last_quantity REAL, last_cost REAL, last_date TEXT)"
+        )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS archived_refuels ("
+        "row INTEGER PRIMARY KEY, odo INTEGER, quantity REAL, cost REAL, "
+        "date TEXT)"
+        )
+    # Reconcile the running totals if they fell out of step with the rows.
+    if read_aggregates(conn).row_count != cached_row_count(conn):
+        rebuild_aggregates(conn)
+    conn.commit()
+    return conn
+
+
+def cached_row_count(conn):
+    """Returns the number of ledger rows held in the cache."""
+    return conn.execute("SELECT COUNT(*) FROM refuels").fetchone()[0]
+
+
+def cached_rows(conn, start=0):
+    """
+    Returns the cached ledger rows from the given 0-based offset as
+    (odo, quantity, cost, date) tuples.
+    """
+    # Cached rows are numbered like worksheet rows, after the header row.
+    return conn.execute(
+        "SELECT odo, quantity, cost, date FROM refuels WHERE row > ? "
+        "ORDER BY row", (start + 1,)
+        ).fetchall()
+
+
+def cache_generation(conn):
+    """
+    Returns the number of times the cache was cleared, so views built from
+    its rows can tell when to rebuild.
+    """
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key = 'generation'"
+        ).fetchone()
+    return int(row[0]) if row else 0
+
+
+def last_cached_row(conn):
+    """
+    Returns the last cached ledger row as an (odo, quantity, cost, date)
+    tuple, or None if the cache is empty.
+    """
+    return conn.execute(
+        "SELECT odo, quantity, cost, date FROM refuels "
+        "ORDER BY row DESC LIMIT 1"
+        ).fetchone()
+
+
+def first_cached_date(conn):
+    """Returns the date of the first dated cached row, or None."""
+    row = conn.execute(
+        "SELECT date FROM refuels WHERE date != '' ORDER BY row LIMIT 1"
+        ).fetchone()
+    return row[0] if row else None
+
+
+def read_summaries(conn):
+    """
+    Returns the cached ArchiveSummary of each archived year of the ledger,
+    by year.
+    """
+    return [
+        storage.ArchiveSummary(*row) for row in conn.execute(
+            "SELECT year, refuels, first_odo, last_odo, fuel_quantity, "
+            "fuel_cost, last_quantity, last_cost, last_date FROM archives "
+            "ORDER BY year"
+            )
+        ]
+
+
+def store_summaries(conn, summaries):
+    """
+    Function to replace the cached archive summaries with those read from
+    the storage.
+    """
+    conn.execute("DELETE FROM archives")
+    conn.executemany(
+        "INSERT INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [tuple(summary) for summary in summaries]
+        )
+    conn.commit()
+
+
+def archived_rows(conn):
+    """
+    Returns the cached refuels of the archived years as (odo, quantity,
+    cost, date) tuples, in order.
+    """
+    return conn.execute(
+        "SELECT odo, quantity, cost, date FROM archived_refuels ORDER BY row"
+        ).fetchall()
+
+
+def sync_archives(conn, ledger, summaries):
+    """
+    Function to cache the archive summaries read from the storage, with
+    the refuels of the archived years.
+    The archived refuels are only read again when the summaries changed,
+    after closed years were archived, so a ledger resync does not read
+    them.
+    """
+    cached_count = conn.execute(
+        "SELECT COUNT(*) FROM archived_refuels"
+        ).fetchone()[0]
+    if (list(summaries) == read_summaries(conn) and cached_count
+            == sum(summary.refuels for summary in summaries)):
+        return
+    import archive
+
+    rows = archive.read_archived_rows(ledger, summaries)
+    conn.execute("DELETE FROM archived_refuels")
+    conn.executemany(
+        "INSERT INTO archived_refuels (odo, quantity, cost, date) "
+        "VALUES (?, ?, ?, ?)", rows
+        )
+    store_summaries(conn, summaries)
+
+
+def head_summary(conn, tail_size):
+    """
+    Function to summarise the cached ledger but its last tail_size rows
+    from the running totals, so the metrics engine can start from them
+    instead of passing over every row.
+    Returns an ArchiveSummary of those rows, with no year, or None if
+    there are none.
+    """
+    totals = read_aggregates(conn)
+    head_count = totals.row_count - tail_size
+    if head_count <= 0:
+        return None
+    last_row, *tail = cached_rows(conn, head_count - 1)
+    return storage.ArchiveSummary(
+        None, head_count, totals.first_odo, last_row[0],
+        totals.total_quantity - sum(row[1] for row in tail),
+        totals.total_cost - sum(row[2] for row in tail),
+        *last_row[1:],
+        )
+
+
+def read_aggregates(conn):
+    """
+    Returns the running totals of the cached ledger as Aggregates.
+    An empty ledger has a row count of 0 and no odometer readings.
+    """
+    row = conn.execute(
+        "SELECT row_count, first_odo, last_odo, total_quantity, total_cost "
+        "FROM aggregates WHERE id = 0"
+        ).fetchone()
+    return Aggregates(*row) if row else Aggregates(0, None, None, 0.0, 0.0)
+
+
+def rebuild_aggregates(conn):
+    """
+    Function to recompute the running totals from every cached row.
+    Used to reconcile the totals with the rows after a resync.
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO aggregates "
+        "SELECT 0, COUNT(*), "
+        "(SELECT odo FROM refuels ORDER BY row LIMIT 1), "
+        "(SELECT odo FROM refuels ORDER BY row DESC LIMIT 1), "
+        "COALESCE(SUM(quantity), 0.0), COALESCE(SUM(cost), 0.0) "
+        "FROM refuels"
+        )
+    conn.commit()
+    return read_aggregates(conn)
+
+
+def clear_cache(conn):
+    """Function to drop every cached row, forcing a full download."""
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+        (str(cache_generation(conn) + 1),)
+        )
+    conn.execute("DELETE FROM refuels")
+    rebuild_aggregates(conn)
+
+
+def fetch_new_rows(conn, storage):
+    """
+    Function to fetch the rows appended to the storage since the last sync.
+    Reads only the tail of the ledger, starting at the last cached row.
+    That overlapping row is compared with the cache: if it differs the ledger
+    was edited, so the cache is cleared and the full ledger is returned.
+    Returns the new rows as lists of strings.
+    """
+    row_count = read_aggregates(conn).row_count
+    if row_count == 0:
+        return pad_rows(storage.read_rows())
+
+    tail = pad_rows(storage.read_rows(row_count - 1))
+    # Cached rows are numbered like worksheet rows, after the header row.
+    last_row = conn.execute(
+        "SELECT odo, quantity, cost, date FROM refuels WHERE row = ?",
+        (row_count + 1,)
+        ).fetchone()
+    if tail and _same_row(tail[0], last_row):
+        return tail[1:]
+
+    clear_cache(conn)
+    return pad_rows(storage.read_rows())
+
+
+def store_rows(conn, rows):
+    """
+    Function to append validated (odo, quantity, cost, date) rows to the
+    cache.
+    Rows are numbered after the rows already cached.
+    Updates the running totals with the new rows in the same transaction.
+    """
+    rows = [tuple(row) for row in rows]
+    if not rows:
+        return
+    totals = read_aggregates(conn)
+    first_row = totals.row_count + 2
+    conn.executemany(
+        "INSERT INTO refuels (row, odo, quantity, cost, date) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(first_row + i, *row) for i, row in enumerate(rows)]
+        )
+    conn.execute(
+        "INSERT OR REPLACE INTO aggregates VALUES (0, ?, ?, ?, ?, ?)",
+        (
+            totals.row_count + len(rows),
+            rows[0][0] if totals.first_odo is None else totals.first_odo,
+            rows[-1][0],
+            totals.total_quantity + sum(row[1] for row in rows),
+            totals.total_cost + sum(row[2] for row in rows),
+        )
+        )
+    conn.commit()
+
+
+def pad_rows(rows):
+    """Pads rows trimmed by the storage to the four ledger columns."""
+    return [list(row[:4]) + [""] * (4 - len(row)) for row in rows]
+
+
+def _same_row(sheet_row, cached_row):
+    """Checks if a worksheet row holds the same values as a cached row."""
+    try:
+        return cached_row is not None and (
+            int(sheet_row[0]), float(sheet_row[1]), float(sheet_row[2]),
+            sheet_row[3]
+            ) == tuple(cached_row)
+    except ValueError:
+        return False
@@ -0,0 +1,236 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import accumulate
+
+
+# Validated snapshot of the ledger, one typed column per field.
+FuelData = namedtuple("FuelData", ["odo", "quantity", "cost", "dates"])
+
+# Metrics of a slice of the ledger.
+PeriodMetrics = namedtuple(
+    "PeriodMetrics",
+    ["distance", "fuel_quantity", "fuel_cost", "gas_mileage", "fuel_price"]
+    )
+
+
+def prefix_sums(values):
+    """
+    Returns the cumulative sums of the values, starting with 0, so the sum
+    of values[start:end] is sums[end] - sums[start].
+    """
+    return list(accumulate(values, initial=0.0))
+
+
+def period_metrics(odo_data, quantity_sums, cost_sums, start, end,
+                   opening_odo=None):
+    """
+    Function to calculate the metrics of the refuels in rows [start, end).
+    The distance runs from the reading before the period to its last
+    reading. A period starting the ledger runs from the opening reading,
+    the last archived one, or else from its first reading.
+    Fuel quantity and cost are prefix sum differences.
+    """
+    if start:
+        first_odo = odo_data[start - 1]
+    else:
+        first_odo = odo_data[0] if opening_odo is None else opening_odo
+    return build_period_metrics(
+        odo_data[end - 1] - first_odo,
+        quantity_sums[end] - quantity_sums[start],
+        cost_sums[end] - cost_sums[start],
+        )
+
+
+def build_period_metrics(distance, fuel_quantity, fuel_cost):
+    """
+    Returns the PeriodMetrics of a distance and the fuel bought over it,
+    with averages left empty when they cannot be calculated.
+    """
+    fuel_quantity = round(fuel_quantity, 2)
+    fuel_cost = round(fuel_cost, 2)
+    gas_mileage = (
+        round(fuel_quantity / distance * 100, 2) if distance else None
+        )
+    fuel_price = (
+        round(fuel_cost / fuel_quantity, 2) if fuel_quantity else None
+        )
+    return PeriodMetrics(
+        distance, fuel_quantity, fuel_cost, gas_mileage, fuel_price
+        )
+
+
+def with_archive(fuel_data, archived_rows):
+    """
+    Returns a FuelData snapshot of the archived (odo, quantity, cost, date)
+    rows followed by the rows of the ledger, spanning its whole history.
+    """
+    if not archived_rows:
+        return fuel_data
+    return FuelData(*(
+        list(archived) + list(column)
+        for archived, column in zip(zip(*archived_rows), fuel_data)
+        ))
+
+
+def opening_odo(summaries):
+    """
+    Returns the last archived odometer reading, from the ArchiveSummary of
+    each archived year, or None if no year is archived.
+    """
+    return summaries[-1].last_odo if summaries else None
+
+
+def opening_date(summaries):
+    """
+    Returns the date of the last archived refuel, or the last day of its
+    year if it is undated, or "" if no year is archived.
+    """
+    if not summaries:
+        return ""
+    return summaries[-1].last_date or f"{summaries[-1].year}-12-31"
+
+
+def archived_year_metrics(summaries):
+    """
+    Returns a dict of the PeriodMetrics of each archived year, from the
+    ArchiveSummary of each year. A year's distance runs from the last
+    reading of the year before, if archived too, to its last reading.
+    """
+    metrics = {}
+    last_odo = None
+    for summary in summaries:
+        first_odo = summary.first_odo if last_odo is None else last_odo
+        metrics[summary.year] = build_period_metrics(
+            summary.last_odo - first_odo,
+            summary.fuel_quantity,
+            summary.fuel_cost,
+            )
+        last_odo = summary.last_odo
+    return metrics
+
+
+class RangeIndex:
+    """
+    Range query engine over a FuelData snapshot.
+    Builds prefix sums of fuel quantity and cost once per load. Odometer
+    readings and refuel dates both grow with each row, so the rows of any
+    range are found by binary search and its totals are prefix sum
+    differences.
+    Ranges spanning closed years need the snapshot of the whole history,
+    built with with_archive(). A snapshot of the current period only
+    starts its first trip from the opening reading, and rejects ranges
+    starting before the opening reading or date, as their archived refuels
+    are not in it.
+    """
+
+    def __init__(self, fuel_data, summaries=()):
+        self.opening_odo = opening_odo(summaries)
+        self.opening_date = opening_date(summaries)
+        self.odo_data = fuel_data.odo
+        self.quantity_sums = prefix_sums(fuel_data.quantity)
+        self.cost_sums = prefix_sums(fuel_data.cost)
+        # Undated refuels take the date of the refuel before them to keep
+        # the dates sorted for binary search.
+        self.dates = list(accumulate(fuel_data.dates, lambda a, b: b or a))
+
+    def odo_range_metrics(self, first_odo, last_odo):
+        """
+        Returns the PeriodMetrics between two odometer readings.
+        The range runs from the first reading at or after first_odo to the
+        last reading at or before last_odo, and counts the fuel of the
+        refuels after its first reading.
+        Returns None if fewer than two readings fall within the range.
+        Raises a ValueError if the range starts before the opening reading.
+        """
+        end = bisect_right(self.odo_data, last_odo)
+        if self.opening_odo is not None and first_odo <= self.opening_odo:
+            if first_odo < self.opening_odo:
+                raise ValueError(
+                    "The refuels before the odometer reading of "
+                    f"{self.opening_odo}km are archived. Please start the "
+                    "range at or after it."
+                    )
+            # The range starts from the opening reading.
+            if not end:
+                return None
+            return period_metrics(
+                self.odo_data, self.quantity_sums, self.cost_sums, 0, end,
+                self.opening_odo
+                )
+        start = bisect_left(self.odo_data, first_odo)
+        if end - start < 2:
+            return None
+        return period_metrics(
+            self.odo_data, self.quantity_sums, self.cost_sums, start + 1, end
+            )
+
+    def date_range_metrics(self, first_date, last_date):
+        """
+        Returns the PeriodMetrics of the refuels between two YYYY-MM-DD
+        dates, inclusive.
+        Returns None if there are no refuels within the range.
+        Raises a ValueError if the range starts on or before the opening
+        date.
+        """
+        if self.opening_date and first_date <= self.opening_date:
+            raise ValueError(
+                f"The refuels up to {self.opening_date} are archived. "
+                "Please start the range after that date."
+                )
+        start = bisect_left(self.dates, first_date)
+        end = bisect_right(self.dates, last_date)
+        if start >= end:
+            return None
+        return period_metrics(
+            self.odo_data, self.quantity_sums, self.cost_sums, start, end,
+            self.opening_odo
+            )
+
+
+class YearIndex(RangeIndex):
+    """
+    Per-year index of a FuelData snapshot.
+    Holds the row boundaries of each year on top of the range index prefix
+    sums, so any year's metrics take a couple of lookups.
+    Refuels are appended in date order, so each year is a contiguous block
+    of rows. Refuels saved before dates were recorded are not part of any
+    year.
+    Archived years are answered from their stored summaries, and start the
+    snapshot's first trip from their last reading.
+    """
+
+    def __init__(self, fuel_data, summaries=()):
+        super().__init__(fuel_data, summaries)
+        self.archived = archived_year_metrics(summaries)
+        self.bounds = {}
+        for row, refuel_date in enumerate(self.dates):
+            if refuel_date:
+                year = int(refuel_date[:4])
+                start = self.bounds.get(year, (row, row))[0]
+                self.bounds[year] = (start, row + 1)
+
+    def years(self):
+        """Returns the years with refuels, in ascending order."""
+        return sorted(set(self.bounds) | set(self.archived))
+
+    def year_metrics(self, year):
+        """
+        Returns the PeriodMetrics of the given year, adding the refuels of
+        the year still in the snapshot to its archived ones.
+        Raises a KeyError if there are no refuels in that year.
+        """
+        if year not in self.bounds:
+            return self.archived[year]
+        start, end = self.bounds[year]
+        metrics = period_metrics(
+            self.odo_data, self.quantity_sums, self.cost_sums, start, end,
+            self.opening_odo
+            )
+        if year in self.archived:
+            archived = self.archived[year]
+            metrics = build_period_metrics(
+                archived.distance + metrics.distance,
+                archived.fuel_quantity + metrics.fuel_quantity,
+                archived.fuel_cost + metrics.fuel_cost,
+                )
+        return metrics
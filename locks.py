@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # No file locks on Windows, locking is skipped.
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Context manager holding an exclusive lock on the lock file next to
+    path, shared by every process of the app.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
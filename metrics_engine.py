@@ -0,0 +1,228 @@
+from collections import namedtuple
+
+
+# One metric plugin. init() returns the starting state, update(state, row)
+# returns the state after one (odo, quantity, cost, date) row, and
+# finalize(state, results) returns the metric's value, given the values of
+# the metrics it requires. Metrics without update are derived from the
+# metrics they require, so they add nothing to the pass over the ledger.
+# combine(state, summary), if given, returns the state after a whole
+# archived year, from its stored ArchiveSummary.
+Metric = namedtuple(
+    "Metric", ["name", "finalize", "init", "update", "requires", "combine"]
+    )
+
+# Registered metrics, by name, in registration order.
+METRICS = {}
+# Last rows of a ledger passed one by one when the rows before them are
+# combined from their running totals: the latest metrics need the last two
+# readings.
+TAIL_ROWS = 2
+
+
+def register_metric(name, finalize, init=None, update=None, requires=(),
+                    combine=None):
+    """
+    Function to register a metric with the engine.
+    A metric may only require metrics registered before it.
+    """
+    missing = [item for item in requires if item not in METRICS]
+    if missing:
+        raise ValueError(
+            f"Metric '{name}' requires unknown metrics: {', '.join(missing)}."
+            )
+    METRICS[name] = Metric(
+        name, finalize, init, update, tuple(requires), combine
+        )
+
+
+def ratio(numerator, denominator, scale=1, digits=2):
+    """
+    Returns numerator / denominator * scale, rounded, or None if it cannot
+    be calculated.
+    """
+    if numerator is None or not denominator:
+        return None
+    return round(numerator / float(denominator) * scale, digits)
+
+
+class MetricsEngine:
+    """
+    Single-pass metrics engine over the rows of a ledger.
+    Each requested metric, and each metric they require, keeps an
+    accumulator state updated once per row, so every metric is calculated
+    in the same pass. Rows can be added as the ledger grows; only the new
+    rows are passed over. The summaries of the archived years, if any, are
+    combined first, so their rows are never read.
+    Raises a KeyError if a requested metric is not registered.
+    """
+
+    def __init__(self, names=None, generation=0):
+        # Generation of the ledger cache the rows come from.
+        self.generation = generation
+        wanted = set()
+        pending = list(METRICS if names is None else names)
+        while pending:
+            name = pending.pop()
+            if name not in wanted:
+                wanted.add(name)
+                pending.extend(METRICS[name].requires)
+        self.metrics = [
+            metric for name, metric in METRICS.items() if name in wanted
+            ]
+        self.states = [
+            metric.init() if metric.init else None for metric in self.metrics
+            ]
+        self.row_count = 0
+
+    def add_summaries(self, summaries):
+        """
+        Combines the ArchiveSummary of each archived year, in order, before
+        any row is added.
+        """
+        for index, metric in enumerate(self.metrics):
+            if metric.combine:
+                for summary in summaries:
+                    self.states[index] = metric.combine(
+                        self.states[index], summary
+                        )
+
+    def skip_rows(self, summary):
+        """
+        Combines the ArchiveSummary of the next rows of the ledger, from
+        its running totals, instead of passing over them, and counts them as
+        added.
+        """
+        self.add_summaries([summary])
+        self.row_count += summary.refuels
+
+    def add_rows(self, rows):
+        """Passes validated (odo, quantity, cost, date) rows, in order."""
+        updates = [
+            (index, metric.update)
+            for index, metric in enumerate(self.metrics) if metric.update
+            ]
+        states = self.states
+        row_count = self.row_count
+        for row in rows:
+            for index, update in updates:
+                states[index] = update(states[index], row)
+            row_count += 1
+        self.row_count = row_count
+
+    def results(self):
+        """Returns a dict of the value of each metric."""
+        results = {}
+        for metric, state in zip(self.metrics, self.states):
+            results[metric.name] = metric.finalize(state, results)
+        return results
+
+
+def calculate_metrics(rows, names=None, summaries=()):
+    """
+    Function to calculate metrics over ledger rows in a single pass,
+    following the archived years of the summaries.
+    Returns a dict of the requested metrics, or of every registered one.
+    """
+    engine = MetricsEngine(names)
+    engine.add_summaries(summaries)
+    engine.add_rows(rows)
+    return engine.results()
+
+
+def metric_set(results, keys):
+    """
+    Returns the metrics of a metric set, by the key each is reported under.
+    """
+    return {key: results[name] for key, name in keys.items()}
+
+
+# Latest metrics:
+register_metric(
+    "latest_trip_distance",
+    lambda state, results: (
+        state[1] - state[0] if state[0] is not None else None
+        ),
+    init=lambda: (None, None),
+    update=lambda state, row: (state[1], row[0]),
+    # The first trip after the archived years starts from their last
+    # reading.
+    combine=lambda state, summary: (None, summary.last_odo),
+    )
+register_metric(
+    "latest_fuel_quantity",
+    lambda state, results: state,
+    update=lambda state, row: row[1],
+    )
+register_metric(
+    "latest_gas_mileage",
+    lambda state, results: ratio(
+        results["latest_fuel_quantity"], results["latest_trip_distance"], 100
+        ),
+    requires=["latest_fuel_quantity", "latest_trip_distance"],
+    )
+
+# Total ownership metrics:
+register_metric(
+    "total_trip_distance",
+    lambda state, results: (
+        state[1] - state[0] if state[0] is not None else None
+        ),
+    init=lambda: (None, None),
+    update=lambda state, row: (
+        row[0] if state[0] is None else state[0], row[0]
+        ),
+    combine=lambda state, summary: (
+        summary.first_odo if state[0] is None else state[0],
+        summary.last_odo
+        ),
+    )
+register_metric(
+    "total_fuel_quantity",
+    lambda state, results: round(state, 2),
+    init=float,
+    update=lambda state, row: state + row[1],
+    combine=lambda state, summary: state + summary.fuel_quantity,
+    )
+register_metric(
+    "total_fuel_cost",
+    lambda state, results: round(state, 2),
+    init=float,
+    update=lambda state, row: state + row[2],
+    combine=lambda state, summary: state + summary.fuel_cost,
+    )
+register_metric(
+    "average_gas_mileage",
+    lambda state, results: ratio(
+        results["total_fuel_quantity"], results["total_trip_distance"], 100
+        ),
+    requires=["total_fuel_quantity", "total_trip_distance"],
+    )
+register_metric(
+    "average_fuel_price",
+    lambda state, results: ratio(
+        results["total_fuel_cost"], results["total_fuel_quantity"]
+        ),
+    requires=["total_fuel_cost", "total_fuel_quantity"],
+    )
+register_metric(
+    "cost_per_km",
+    lambda state, results: ratio(
+        results["total_fuel_cost"], results["total_trip_distance"], digits=3
+        ),
+    requires=["total_fuel_cost", "total_trip_distance"],
+    )
+
+# Metric sets shown together, by the key each metric is reported under.
+LATEST_METRICS = {
+    "trip_distance": "latest_trip_distance",
+    "gas_mileage": "latest_gas_mileage",
+    }
+TOTAL_METRICS = {
+    "trip_distance": "total_trip_distance",
+    "fuel_quantity": "total_fuel_quantity",
+    "fuel_cost": "total_fuel_cost",
+    "gas_mileage": "average_gas_mileage",
+    "fuel_price": "average_fuel_price",
+    "cost_per_km": "cost_per_km",
+    }
@@ -0,0 +1,202 @@
+import json
+import math
+import os
+import sys
+
+import archive
+import ledger_index
+import metrics_engine
+import storage
+import validation
+
+
+# NumPy, imported on first use, so the app starts without loading it
+# unless the engine is selected.
+np = None
+
+
+def load_numpy():
+    """
+    Function to import NumPy on first use.
+    Returns True if it is installed.
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:  # NumPy is optional, the app uses pure Python.
+            return False
+        np = numpy
+    return True
+
+
+def enabled():
+    """
+    Checks if the NumPy metrics engine is selected and installed.
+    The engine is selected with CFM_ENGINE=numpy. NumPy is only imported
+    once it is.
+    """
+    return os.environ.get("CFM_ENGINE") == "numpy" and load_numpy()
+
+
+def parse_columns(rows):
+    """
+    Function to parse ledger rows straight into typed NumPy arrays.
+    NumPy must be loaded first, see enabled().
+    Returns the odometer (int64), fuel quantity and fuel cost (float64)
+    arrays.
+    Raises a ValueError naming the column if any value is invalid.
+    """
+    table = np.array([row[:3] for row in rows], dtype=str).reshape(-1, 3)
+    columns = []
+    for col, (name, dtype) in enumerate([
+            ("Odometer readings", np.int64),
+            ("Fuel quantity", np.float64),
+            ("Fuel cost", np.float64)]):
+        try:
+            columns.append(table[:, col].astype(dtype))
+        except ValueError:
+            raise ValueError(f"{name} data is invalid.") from None
+    return tuple(columns)
+
+
+def validate_rows(rows, previous=None):
+    """
+    Function to validate ledger rows with vectorised operations.
+    Applies the rules of validation.validate_ledger() that make a row
+    invalid to whole columns at once, carrying on from the previous
+    validated row, if any.
+    Returns the rows as (odo, quantity, cost, date) tuples, or None if any
+    row breaks a rule, so validate_ledger() can report them.
+    """
+    try:
+        odo_data, fuel_quantity_data, fuel_cost_data = parse_columns(rows)
+    except ValueError:
+        return None
+    readings = np.concatenate([[previous[0]] if previous else [], odo_data])
+    if ((odo_data < 0).any() or (np.diff(readings) < 0).any()
+            or not np.isfinite(fuel_quantity_data).all()
+            or not np.isfinite(fuel_cost_data).all()
+            or (fuel_quantity_data <= 0).any()
+            or (fuel_quantity_data > validation.MAX_FUEL_QUANTITY).any()
+            or (fuel_cost_data <= 0).any()):
+        return None
+    dates = [row[3] for row in rows]
+    known_dates = [previous[3]] if previous and previous[3] else []
+    known_dates += [item for item in dates if item]
+    if (any(validation.date_error(item) for item in known_dates)
+            or known_dates != sorted(known_dates)):
+        return None
+    return list(zip(
+        odo_data.tolist(), fuel_quantity_data.tolist(),
+        fuel_cost_data.tolist(), dates
+        ))
+
+
+def calculate_metrics(odo_data, fuel_quantity_data, fuel_cost_data,
+                      summaries=()):
+    """
+    Function to calculate every fuel metric with vectorised operations.
+    Computes per-trip distance with np.diff and per-trip gas mileage from
+    the fuel of the refuel ending each trip, then the latest and total
+    metrics from those arrays. The first trip starts from the last archived
+    reading, and the totals include the summaries of the archived years.
+    Metrics that cannot be calculated, like the latest metrics of a ledger
+    with a single reading, are None, and so is the per-trip gas mileage of
+    zero-distance trips.
+    Returns a dict of the metrics, with the per-trip arrays.
+    """
+    opening_odo = ledger_index.opening_odo(summaries)
+    readings = odo_data if opening_odo is None else np.concatenate(
+        [[opening_odo], odo_data]
+        )
+    trip_distance = np.diff(readings)
+    trip_fuel = fuel_quantity_data[len(odo_data) - len(trip_distance):]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        trip_gas_mileage = np.round(trip_fuel / trip_distance * 100, 2)
+    trip_gas_mileage = [
+        value if math.isfinite(value) else None
+        for value in trip_gas_mileage.tolist()
+        ]
+
+    if len(trip_distance):
+        latest_distance = int(trip_distance[-1])
+        latest_gas_mileage = trip_gas_mileage[-1]
+    else:
+        latest_distance = latest_gas_mileage = None
+    if summaries:
+        first_odo = summaries[0].first_odo
+    else:
+        first_odo = int(odo_data[0]) if len(odo_data) else None
+    last_odo = int(readings[-1]) if len(readings) else None
+    total_distance = None if first_odo is None else last_odo - first_odo
+    total_fuel_quantity = float(fuel_quantity_data.sum()) + sum(
+        summary.fuel_quantity for summary in summaries
+        )
+    total_fuel_cost = float(fuel_cost_data.sum()) + sum(
+        summary.fuel_cost for summary in summaries
+        )
+    return {
+        "latest_trip_distance": latest_distance,
+        "latest_gas_mileage": latest_gas_mileage,
+        "total_trip_distance": total_distance,
+        "total_fuel_quantity": round(total_fuel_quantity, 2),
+        "total_fuel_cost": round(total_fuel_cost, 2),
+        "average_gas_mileage": metrics_engine.ratio(
+            total_fuel_quantity, total_distance, 100
+            ),
+        "average_fuel_price": metrics_engine.ratio(
+            total_fuel_cost, total_fuel_quantity
+            ),
+        "cost_per_km": metrics_engine.ratio(
+            total_fuel_cost, total_distance, digits=3
+            ),
+        "trip_distance": trip_distance.tolist(),
+        "trip_gas_mileage": trip_gas_mileage,
+    }
+
+
+def main():
+    """
+    Command line entry point printing every metric of the configured
+    storage as JSON, including the per-trip distances and gas mileages:
+    python3 numpy_metrics.py
+    The ledger is validated like in the app, carried on from its archived
+    years, whose summaries are included in the totals. Metrics that cannot
+    be calculated are printed as null.
+    """
+    if not load_numpy():
+        print("NumPy is not installed. Run: pip install numpy")
+        return 1
+    ledger = storage.get_storage()
+    summaries = ledger.read_summaries()
+    previous = archive.previous_row(summaries)
+    rows = ledger.read_rows()
+    valid_rows = validate_rows(rows, previous)
+    if valid_rows is None:
+        valid_rows, issues = validation.validate_ledger(
+            enumerate(rows, start=2), previous
+            )
+        errors = [issue for issue in issues if not issue.warning]
+        if errors:
+            for issue in errors:
+                print(
+                    f"Row {issue.row}, {issue.column}: {issue.message}",
+                    file=sys.stderr
+                    )
+            return 1
+    odo_data, fuel_quantity_data, fuel_cost_data, _ = (
+        zip(*valid_rows) if valid_rows else ([], [], [], [])
+        )
+    metrics = calculate_metrics(
+        np.array(odo_data, dtype=np.int64),
+        np.array(fuel_quantity_data, dtype=np.float64),
+        np.array(fuel_cost_data, dtype=np.float64),
+        summaries,
+        )
+    print(json.dumps(metrics, indent=2, allow_nan=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+from collections import deque
+from datetime import date, timedelta
+
+import ledger_index
+
+
+# Rolling metrics setup:
+ROLLING_REFUELS = 5  # Refuels in the last refuels window.
+ROLLING_DAYS = 90  # Days in the last days window.
+
+
+class RollingWindow:
+    """
+    Sliding window over the most recent refuels of a ledger.
+    Holds the refuels within the window with running sums of their fuel,
+    so adding a refuel and evicting the oldest one take constant time.
+    The window keeps at most max_refuels refuels, and only those dated
+    within max_days of the newest refuel, or of today when the metrics are
+    read. Undated refuels take the date of the refuel before them.
+    """
+
+    def __init__(self, max_refuels=None, max_days=None):
+        self.max_refuels = max_refuels
+        self.max_days = max_days
+        self.refuels = deque()
+        # Odometer reading the window's distance starts from: the last
+        # evicted refuel, or else the first refuel of the ledger.
+        self.start_odo = None
+        self.last_date = ""
+        self.fuel_quantity = 0.0
+        self.fuel_cost = 0.0
+
+    def add(self, odo_data, fuel_quantity, fuel_cost, refuel_date=""):
+        """Adds the next refuel, evicting those falling out of the window."""
+        self.last_date = refuel_date or self.last_date
+        if self.start_odo is None:
+            self.start_odo = odo_data
+        self.refuels.append(
+            (odo_data, fuel_quantity, fuel_cost, self.last_date)
+            )
+        self.fuel_quantity += fuel_quantity
+        self.fuel_cost += fuel_cost
+        if self.max_refuels is not None and (
+                len(self.refuels) > self.max_refuels):
+            self.evict()
+        if self.max_days is not None and self.last_date:
+            self.evict_before(date.fromisoformat(self.last_date))
+
+    def evict(self):
+        """Evicts the oldest refuel of the window."""
+        odo_data, fuel_quantity, fuel_cost, _ = self.refuels.popleft()
+        self.start_odo = odo_data
+        if self.refuels:
+            self.fuel_quantity -= fuel_quantity
+            self.fuel_cost -= fuel_cost
+        else:
+            # Restart the sums from zero, dropping any rounding drift.
+            self.fuel_quantity = self.fuel_cost = 0.0
+
+    def evict_before(self, newest_date):
+        """Evicts the refuels older than max_days before newest_date."""
+        first_date = (newest_date - timedelta(days=self.max_days)).isoformat()
+        while self.refuels and self.refuels[0][3] < first_date:
+            self.evict()
+
+    def metrics(self, today=None):
+        """
+        Returns the PeriodMetrics of the refuels in the window, from the
+        reading before its first refuel to its last reading.
+        Returns None if the window is empty.
+        """
+        if self.max_days is not None:
+            self.evict_before(today or date.today())
+        if not self.refuels:
+            return None
+        return ledger_index.build_period_metrics(
+            self.refuels[-1][0] - self.start_odo,
+            self.fuel_quantity,
+            self.fuel_cost,
+            )
+
+
+class RollingMetrics:
+    """
+    Trend metrics of a ledger: the last ROLLING_REFUELS refuels and the
+    last ROLLING_DAYS days.
+    Fed with the ledger rows as they are appended, so refreshing the trends
+    after an upload only adds the new rows. The refuels of archived years
+    are added first, so the windows span the closed years too.
+    """
+
+    def __init__(self, generation=0, refuels=ROLLING_REFUELS,
+                 days=ROLLING_DAYS):
+        # Generation of the ledger cache the rows come from.
+        self.generation = generation
+        self.windows = {
+            f"last_{refuels}_refuels": RollingWindow(max_refuels=refuels),
+            f"last_{days}_days": RollingWindow(max_days=days),
+            }
+        self.row_count = 0
+
+    def add_archive(self, rows):
+        """
+        Adds the validated (odo, quantity, cost, date) rows of the archived
+        years, in order, before the ledger rows. They are not counted in
+        row_count, the number of ledger rows added.
+        """
+        for row in rows:
+            for window in self.windows.values():
+                window.add(*row)
+
+    def add_rows(self, rows):
+        """Adds validated (odo, quantity, cost, date) rows, in order."""
+        for row in rows:
+            for window in self.windows.values():
+                window.add(*row)
+            self.row_count += 1
+
+    def results(self, today=None):
+        """
+        Returns a dict of the PeriodMetrics of each window, or None for the
+        windows without refuels.
+        """
+        return {
+            name: window.metrics(today)
+            for name, window in self.windows.items()
+            }
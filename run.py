@@ -1,19 +1,60 @@
-import gspread
-from google.oauth2.service_account import Credentials
-
+import argparse
+import asyncio
+from datetime import date
+
+import archive
+import async_storage
+import fleet
+import instrumentation
+import journal
+import ledger_cache
+import ledger_index
+import metrics_engine
+import numpy_metrics
+import rolling
+import snapshot
+import storage
+import validation
+
+
+def open_ledger(vehicle):
+    """
+    Function to open the storage, local cache and journal of a vehicle's
+    ledger.
+    Sets them as the STORAGE, CACHE and JOURNAL used by every screen, with
+    the SNAPSHOT_PATH of the ledger's columnar snapshot and the metrics
+    ENGINE and ROLLING windows fed with its rows.
+    """
+    global STORAGE, CACHE, SNAPSHOT_PATH, JOURNAL, ENGINE, ROLLING
+    # Storage backend, selected with the CFM_STORAGE environment variable.
+    STORAGE = storage.get_storage(vehicle=vehicle)
+    # Local cache of the validated ledger, synced with the storage on each
+    # read.
+    CACHE = ledger_cache.open_cache(
+        STORAGE.source,
+        ledger_cache.cache_path(vehicle) if STORAGE.persistent else ":memory:"
+        )
+    # Columnar snapshot of the cache, memory-mapped by the metric views.
+    SNAPSHOT_PATH = (
+        snapshot.snapshot_path(vehicle) if STORAGE.persistent else None
+        )
+    # Journal of the saved refuels, uploaded to the storage in the
+    # background.
+    JOURNAL = journal.open_journal(
+        STORAGE,
+        journal.journal_path(vehicle) if STORAGE.persistent else None,
+        ledger_cache.read_aggregates(CACHE).row_count
+        )
+    # Accumulators of the latest and total metrics, fed with the cached rows.
+    ENGINE = metrics_engine.MetricsEngine(
+        generation=ledger_cache.cache_generation(CACHE)
+        )
+    # Rolling windows of the trend metrics, fed with the cached rows.
+    ROLLING = rolling.RollingMetrics(ledger_cache.cache_generation(CACHE))
 
-# Google Sheets API setup:
-SCOPE = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
 
-CREDS = Credentials.from_service_account_file('creds.json')
-SCOPED_CREDS = CREDS.with_scopes(SCOPE)
-GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-SHEET = GSPREAD_CLIENT.open('ci_car_fuel_metrics')
-WORKSHEET = SHEET.worksheet('fuel_data')
+# Ledger used by every screen, opened by main() or a vehicle selection.
+STORAGE = CACHE = SNAPSHOT_PATH = JOURNAL = ENGINE = ROLLING = None
 
 
 # Menu Navigation functions:
@@ -21,22 +62,52 @@ def select_mode():
     """
     Function to select the mode of the app.
     Run a while loop until the user selects a valid mode.
-    Calls the data_input() function if mode is 1.
-    Calls the select_metrics() function if mode is 2.
+    Returns the data input screen if mode is 1.
+    Returns the metrics selection screen if mode is 2.
+    Returns the vehicle selection screen if mode is 3.
     """
     while True:
         print("Please select mode:")
         print("1: Input Fueling Data")
         print("2: View Metrics")
+        print(f"3: Select Vehicle (current: {STORAGE.vehicle})")
 
         mode = input("Enter the number of your selected mode: \n")
 
         if mode == "1":
-            data_input()
-            break
+            return "data_input"
         elif mode == "2":
-            select_metrics()
-            break
+            return "select_metrics"
+        elif mode == "3":
+            return "select_vehicle"
+        else:
+            print("Invalid input. Please try again.")
+
+
+def select_vehicle():
+    """
+    Function to select the vehicle of the fleet to work with.
+    Run a while loop until the user selects one of the vehicles.
+    Opens the selected vehicle's ledger and returns the mode selection
+    screen.
+    """
+    try:
+        vehicles = storage.get_backend().list_vehicles()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return "select_mode"
+
+    while True:
+        print("Please select a vehicle:")
+        for number, vehicle in enumerate(vehicles, start=1):
+            print(f"{number}: {vehicle}")
+
+        selection = input("Enter the number of your selected vehicle: \n")
+
+        if selection.isdigit() and 1 <= int(selection) <= len(vehicles):
+            open_ledger(vehicles[int(selection) - 1])
+            print(f"Selected vehicle: {STORAGE.vehicle}\n")
+            return "select_mode"
         else:
             print("Invalid input. Please try again.")
 
@@ -45,220 +116,456 @@ def select_metrics():
     """
     Function to select metrics type.
     Run a while loop until the user selects a valid option.
-    Calls the latest_metrics() function if user selection is 1.
-    Calls the select_year function if user selection is 2.
-    Calls the total_ownership_metrics() function if user selection is 3.
-    Calls the select_mode() function if user selection is 4.
+    Returns the latest metrics screen if user selection is 1.
+    Returns the annual metrics screen if user selection is 2.
+    Returns the range metrics screen if user selection is 3.
+    Returns the total ownership metrics screen if user selection is 4.
+    Returns the rolling metrics screen if user selection is 5.
+    Returns the fleet summary screen if user selection is 6.
+    Returns the mode selection screen if user selection is 7.
     """
 
     while True:
         print("Please select which metrics you would like to see:")
         print("1: Latest Fueling Metrics")
-        print("2: Total Ownership Metrics")
-        print("3: Back to Mode Selection")
+        print("2: Annual Metrics")
+        print("3: Range Metrics")
+        print("4: Total Ownership Metrics")
+        print("5: Rolling Metrics (recent trends)")
+        print("6: Fleet Summary")
+        print("7: Back to Mode Selection")
 
         mode = input("Enter the number of your selected metrics: \n")
 
         if mode == "1":
-            latest_metrics()
-            break
+            return "latest_metrics"
         elif mode == "2":
-            total_ownership_metrics()
-            break
+            return "annual_metrics"
         elif mode == "3":
-            select_mode()
-            break
+            return "range_metrics"
+        elif mode == "4":
+            return "total_ownership_metrics"
+        elif mode == "5":
+            return "rolling_metrics"
+        elif mode == "6":
+            return "fleet_summary"
+        elif mode == "7":
+            return "select_mode"
         else:
             print("Invalid input. Please try again.")
 
 
 # Main Metrics functions:
 def latest_metrics():
-    """This function prints metrics from the latest refueling."""
-    trip_distance = calculate_latest_trip_distance()
-    latest_gas_mileage = calculate_latest_gas_mileage()
+    """
+    This function prints metrics from the latest refueling.
+    Reads them from the metrics engine, brought up to date with the rows
+    added since the last view.
+    Returns the mode selection screen if the data could not be loaded.
+    """
+    results = load_metrics()
+    if results is None:
+        return "select_mode"
+    if results["latest_trip_distance"] is None:
+        print("Not enough data available. At least two refuels are needed.")
+        return "select_mode"
     print("\n")
     print("Latest Fueling Metrics:")
-    print(f"Latest Trip Distance: {trip_distance}km.")
-    print(f"Latest Gas Mileage: {latest_gas_mileage}l/100km.\n")
-    navigate_metrics()
-
-
-def total_ownership_metrics():
-    """This function prints the total ownership metrics."""
-    total_distance = calculate_total_trip_distance()
-    total_fuel_quantity = calculate_total_fuel_quantity()
-    total_fuel_cost = calculate_total_fuel_cost()
-    average_gas_mileage = calculate_total_average_gas_mileage()
-    average_fuel_price = calculate_total_average_fuel_price()
-
-    print("\n")
-    print("Total Ownership Metrics:")
-    print(f"Total Trip Distance: {total_distance}km.")
-    print(f"Total Fuel Quantity: {total_fuel_quantity}l.")
-    print(f"Total Fuel Cost: ${total_fuel_cost}EUR.")
-    print(f"Average Gas Mileage: {average_gas_mileage}l/100km.")
-    print(f"Average Fuel Price: ${average_fuel_price}EUR/l.\n")
-    navigate_metrics()
+    print(f"Latest Trip Distance: {results['latest_trip_distance']}km.")
+    print(
+        "Latest Gas Mileage: "
+        f"{metric_text(results['latest_gas_mileage'], 'l/100km')}.\n"
+        )
+    return "navigate_metrics"
 
 
-# Latest metrics calculation functions:
-def calculate_latest_gas_mileage():
+def metric_text(value, unit, prefix=""):
     """
-    Calculates the latest gas mileage.
-    Calls calculate_latest_trip_distance() to get the latest trip distance and
-    converts it to a float.
-    Calls validate_data(2) to get the fuel quantity data.
-    Computes gas mileage by dividing the latest fuel quantity by the latest
-    trip distance, then multiplying by 100 to get l/100km.
+    Returns a metric value with its unit for display, or "n/a" if it cannot
+    be calculated, like a gas mileage over no distance.
     """
-    latest_trip_distance = float(calculate_latest_trip_distance())
-    fuel_quantity_data = validate_data(2)  # This is a list of floats
-    latest_fuel_quantity = fuel_quantity_data[-1]  # type: ignore
-    return round(latest_fuel_quantity / latest_trip_distance * 100, 2)
+    return "n/a" if value is None else f"{prefix}{value}{unit}"
 
 
-def calculate_latest_trip_distance():
+def annual_metrics():
     """
-    Function to calculate the latest trip distance.
-    Calls the validate_data(1) function to validate odometer readings data.
-    Calculates the latest trip distance by subtracting the last two readings.
+    This function prints the metrics of a year selected by the user.
+    Builds the per-year index of the fuel data snapshot, then runs a while
+    loop until the user selects one of the years with dated refuels.
+    Returns the metrics selection screen if there are no dated refuels.
     """
-    odo_data = validate_data(1)
-    latest_trip_distance = odo_data[-1] - odo_data[-2]
-    return latest_trip_distance
+    fuel_data = validate_data()
+    if fuel_data is None:
+        return "select_mode"
+    year_index = ledger_index.YearIndex(
+        fuel_data, ledger_cache.read_summaries(CACHE)
+        )
+    years = [str(year) for year in year_index.years()]
+    if not years:
+        print("No dated refuels available yet.\n")
+        return "select_metrics"
 
+    while True:
+        print(f"Years with refuels: {', '.join(years)}")
+        year = input("Enter the year of your selected metrics: \n")
+        if year in years:
+            break
+        print("Invalid input. Please try again.")
 
-# Total ownership metrics calculation functions:
-def calculate_total_trip_distance():
+    metrics = year_index.year_metrics(int(year))
+    print("\n")
+    print(f"Annual Metrics {year}:")
+    print(f"Annual Trip Distance: {metrics.distance}km.")
+    print(f"Annual Fuel Quantity: {metrics.fuel_quantity}l.")
+    print(f"Annual Fuel Cost: ${metrics.fuel_cost}EUR.")
+    print(
+        f"Average Gas Mileage: {metric_text(metrics.gas_mileage, 'l/100km')}."
+        )
+    print(
+        f"Average Fuel Price: {metric_text(metrics.fuel_price, 'EUR/l', '$')}"
+        ".\n"
+        )
+    return "navigate_metrics"
+
+
+def range_metrics():
     """
-    Calculates the total trip distance.
-    Calls validate_data(1) to retrieve odometer readings.
-    Computes total distance by subtracting the first reading from the last.
+    This function prints the metrics between two odometer readings or two
+    dates selected by the user.
+    Builds the range index of the fuel data snapshot, preceded by the
+    cached refuels of the archived years, which answers the query with
+    binary search and prefix sum differences.
+    Returns the metrics selection screen if no refuels fall in the range.
     """
+    fuel_data = validate_data()
+    if fuel_data is None:
+        return "select_mode"
+    range_index = ledger_index.RangeIndex(ledger_index.with_archive(
+        fuel_data, ledger_cache.archived_rows(CACHE)
+        ))
 
-    odo_data = validate_data(1)
-    total_trip_distance = odo_data[-1] - odo_data[0]
-    return total_trip_distance
+    while True:
+        print("Please select the range type:")
+        print("1: Between Odometer Readings")
+        print("2: Between Dates")
+        range_type = input("Enter the number of your selected range: \n")
+        if range_type in ("1", "2"):
+            break
+        print("Invalid input. Please try again.")
 
+    if range_type == "1":
+        first, last = range_data_input("odometer reading", str.isdigit)
+        metrics = range_index.odo_range_metrics(int(first), int(last))
+        unit = "km"
+    else:
+        first, last = range_data_input(
+            "date (YYYY-MM-DD)",
+            lambda item: item and not validation.date_error(item)
+            )
+        metrics = range_index.date_range_metrics(first, last)
+        unit = ""
+    if metrics is None:
+        print("Not enough refuels in the selected range.\n")
+        return "select_metrics"
 
-def calculate_total_fuel_quantity():
-    """
-    Function to calculate the total fuel quantity.
-    Calls the validate_data(2) function to validate fuel quantity data.
-    Calculates the total fuel quantity by summing all the fuel quantity data.
-    """
-    fuel_quantity_data = validate_data(2)
-    total_fuel_quantity = sum(fuel_quantity_data)
-    return total_fuel_quantity
+    print("\n")
+    print(f"Range Metrics {first}{unit} - {last}{unit}:")
+    print(f"Trip Distance: {metrics.distance}km.")
+    print(f"Fuel Quantity: {metrics.fuel_quantity}l.")
+    print(f"Fuel Cost: ${metrics.fuel_cost}EUR.")
+    print(
+        f"Average Gas Mileage: {metric_text(metrics.gas_mileage, 'l/100km')}."
+        )
+    print(
+        f"Average Fuel Price: {metric_text(metrics.fuel_price, 'EUR/l', '$')}"
+        ".\n"
+        )
+    return "navigate_metrics"
 
 
-def calculate_total_fuel_cost():
+def range_data_input(label, is_valid):
     """
-    Function to calculate the total fuel cost.
-    Calls the validate_data(3) function to validate fuel cost data.
-    Calculates the total fuel cost by summing all the fuel cost data.
+    Function to input the two ends of a metrics range.
+    Run a while loop until the user inputs two valid values, the first not
+    greater than the second.
     """
-    fuel_cost_data = validate_data(3)
-    total_fuel_cost = sum(fuel_cost_data)
-    return round(total_fuel_cost, 2)
+    while True:
+        first = input(f"Enter the first {label}: \n")
+        last = input(f"Enter the last {label}: \n")
+        if not (is_valid(first) and is_valid(last)):
+            print(f"Invalid input. Please enter a valid {label}.")
+        elif (int(first) > int(last)) if first.isdigit() else first > last:
+            print("The first value must not be greater than the last one.")
+        else:
+            return first, last
 
 
-def calculate_total_average_gas_mileage():
+def total_ownership_metrics():
     """
-    Function to calculate the total average gas mileage.
-    Calls the calculate_total_trip_distance() function to get the total trip
-    distance and converts it to a float.
-    Calls the calculate_total_fuel_quantity() function to get the total fuel
-    quantity.
-    Calculates the total average gas mileage by dividing the total fuel
-    quantity by the total trip distance and multiplying by 100 resulting in
-    l/100km.
+    This function prints the total ownership metrics.
+    Reads them from the metrics engine, which only passes over the rows
+    added since the last view, so the cost of a view does not grow with
+    the length of the history.
+    Returns the mode selection screen if the data could not be loaded.
     """
-    total_trip_distance = float(calculate_total_trip_distance())
-    total_fuel_quantity = calculate_total_fuel_quantity()
-    return round(total_fuel_quantity / total_trip_distance * 100, 2)
+    results = load_metrics()
+    if results is None:
+        return "select_mode"
+    if not results["total_trip_distance"]:
+        print(
+            "Not enough data available. At least two refuels with some "
+            "distance driven between them are needed."
+            )
+        return "select_mode"
 
+    gas_mileage = metric_text(results["average_gas_mileage"], "l/100km")
+    fuel_price = metric_text(results["average_fuel_price"], "EUR/l", "$")
+    cost_per_km = metric_text(results["cost_per_km"], "EUR/km", "$")
+    print("\n")
+    print("Total Ownership Metrics:")
+    print(f"Total Trip Distance: {results['total_trip_distance']}km.")
+    print(f"Total Fuel Quantity: {results['total_fuel_quantity']}l.")
+    print(f"Total Fuel Cost: ${results['total_fuel_cost']}EUR.")
+    print(f"Average Gas Mileage: {gas_mileage}.")
+    print(f"Average Fuel Price: {fuel_price}.")
+    print(f"Fuel Cost per km: {cost_per_km}.\n")
+    return "navigate_metrics"
+
+
+def load_metrics():
+    """
+    Function to bring the metrics engine up to date with the ledger.
+    Loads the ledger snapshot and passes the rows added since the last
+    view to the engine's accumulators, rebuilding them if the cache was
+    resynced since. Rebuilt accumulators start from the summaries of the
+    archived years and the running totals of the cache, and only pass
+    over its last rows, so the first view is as cheap as the next ones.
+    Returns a dict of every registered metric, or None if the data could
+    not be loaded.
+    """
+    global ENGINE
+    fuel_data = validate_data()
+    if fuel_data is None:
+        return None
+    generation = ledger_cache.cache_generation(CACHE)
+    if (generation != ENGINE.generation or not ENGINE.row_count
+            or len(fuel_data.odo) < ENGINE.row_count):
+        ENGINE = metrics_engine.MetricsEngine(generation=generation)
+        ENGINE.add_summaries(ledger_cache.read_summaries(CACHE))
+        head = ledger_cache.head_summary(CACHE, metrics_engine.TAIL_ROWS)
+        if head is not None:
+            ENGINE.skip_rows(head)
+    start = ENGINE.row_count
+    ENGINE.add_rows(zip(*(column[start:] for column in fuel_data)))
+    return ENGINE.results()
+
+
+def rolling_metrics():
+    """
+    This function prints the trend metrics of the last refuels and of the
+    last days.
+    Only the rows added since the last view are fed to the rolling windows,
+    so refreshing the trends after an upload stays cheap.
+    Returns the mode selection screen if the data could not be loaded.
+    """
+    trends = load_rolling_metrics()
+    if trends is None:
+        return "select_mode"
 
-def calculate_total_average_fuel_price():
+    print("\n")
+    print("Rolling Metrics:")
+    for name, metrics in trends.results().items():
+        label = name.replace("_", " ").capitalize()
+        if metrics is None:
+            print(f"{label}: no refuels.")
+        else:
+            print(
+                f"{label}: {metrics.distance}km, "
+                f"{metrics.fuel_quantity}l, ${metrics.fuel_cost}EUR, "
+                f"{metric_text(metrics.gas_mileage, 'l/100km')}, "
+                f"{metric_text(metrics.fuel_price, 'EUR/l', '$')}."
+                )
+    print()
+    return "navigate_metrics"
+
+
+def load_rolling_metrics():
     """
-    Function to calculate the total average fuel price
-    Calls the calculate_total_fuel_cost() function to get the total fuel cost.
-    Calls the calculate_total_fuel_quantity() function to get the total fuel
-    quantity.
-    Calculates the total average fuel price by dividing the total fuel cost by
-    the total fuel quantity.
+    Function to bring the rolling windows up to date with the ledger.
+    Syncs the cache and adds its new rows to the windows, rebuilding them
+    if the cache was resynced since. Rebuilt windows start with the cached
+    refuels of the archived years.
+    Returns the RollingMetrics, or None if the data could not be loaded.
     """
-    total_fuel_cost = calculate_total_fuel_cost()
-    total_fuel_quantity = calculate_total_fuel_quantity()
-    return round(total_fuel_cost / total_fuel_quantity, 2)
+    global ROLLING
+    if not sync_data():
+        return None
+    generation = ledger_cache.cache_generation(CACHE)
+    if generation != ROLLING.generation or not ROLLING.row_count:
+        ROLLING = rolling.RollingMetrics(generation)
+        ROLLING.add_archive(ledger_cache.archived_rows(CACHE))
+    ROLLING.add_rows(ledger_cache.cached_rows(CACHE, ROLLING.row_count))
+    return ROLLING
 
 
-# Validate data retrieval from Google Sheets:
-def validate_data(col_num):
+def fleet_summary():
+    """
+    This function prints the total ownership metrics of every vehicle,
+    ranked by average gas mileage.
+    All the ledgers are read at once, so the summary costs about as much as
+    a single vehicle.
     """
-    Function to validate data retrieval from Google Sheets.
-    Retrieves data from the Google Sheet based on the column number,
-    and calls the appropriate validation function.
-    Throws an error message and returns to the mode selection menu if an error.
+    try:
+        summaries, skipped = fleet.fleet_summary()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return "select_mode"
+
+    print("\n")
+    print("Fleet Summary (ranked by average gas mileage):")
+    cost_ranks = {
+        summary.vehicle: rank for rank, summary in enumerate(
+            sorted(summaries, key=lambda item: item.cost_per_100km), start=1
+            )
+        }
+    for rank, summary in enumerate(summaries, start=1):
+        print(
+            f"{rank}. {summary.vehicle}: {summary.gas_mileage}l/100km, "
+            f"${summary.cost_per_100km}EUR/100km "
+            f"(cost rank {cost_ranks[summary.vehicle]}), "
+            f"{summary.distance}km, ${summary.fuel_cost}EUR total."
+            )
+    if skipped:
+        print(f"Not enough data for: {', '.join(skipped)}.")
+    print()
+    return "navigate_metrics"
+
+
+# Validate data retrieval from the storage:
+def sync_data(require_data=True):
+    """
+    Function to validate data retrieval from the storage backend.
+    Uploads the refuels pending in the journal first, so they are part of
+    the data.
+    Syncs the local ledger cache by fetching only the rows added since the
+    last sync, and validates the new rows in a single pass before storing
+    them. The NumPy engine checks them with vectorised operations first.
+    The summaries of the archived years are cached along with the rows,
+    whenever the full ledger is read, and read concurrently with the rows
+    when nothing is cached yet. The archived refuels are cached too, read
+    again only when the summaries change.
+    Once the ledger starts in a closed year, those refuels are archived and
+    the cache is synced again.
+    Returns True if the cache holds validated data to calculate metrics from,
+    or is up to date when require_data is False.
+    Throws an error message and returns False if an error.
     """
     try:
-        data = WORKSHEET.col_values(col_num)
-        # Check if there are no readings or only the header row.
-        if not data or len(data) < 2:
+        JOURNAL.try_flush()
+        generation = ledger_cache.cache_generation(CACHE)
+        if ledger_cache.read_aggregates(CACHE).row_count == 0:
+            # Nothing is cached: the whole ledger and the archive summaries
+            # are read concurrently.
+            rows, summaries = asyncio.run(
+                async_storage.gather_ledger(STORAGE)
+                )
+            new_rows = ledger_cache.pad_rows(rows)
+            ledger_cache.sync_archives(CACHE, STORAGE, summaries)
+        else:
+            new_rows = ledger_cache.fetch_new_rows(CACHE, STORAGE)
+            if ledger_cache.cache_generation(CACHE) != generation:
+                ledger_cache.sync_archives(
+                    CACHE, STORAGE, STORAGE.read_summaries()
+                    )
+        if new_rows:
+            previous = ledger_cache.last_cached_row(CACHE)
+            if previous is None:
+                previous = archive.previous_row(
+                    ledger_cache.read_summaries(CACHE)
+                    )
+            validated_rows = None
+            if numpy_metrics.enabled():
+                validated_rows = numpy_metrics.validate_rows(
+                    new_rows, previous
+                    )
+            if validated_rows is None:
+                first_row = ledger_cache.read_aggregates(CACHE).row_count + 2
+                validated_rows, issues = validation.validate_ledger(
+                    enumerate(new_rows, start=first_row), previous
+                    )
+                errors = [issue for issue in issues if not issue.warning]
+                if errors:
+                    report_ledger_errors(errors)
+                    return False
+            ledger_cache.store_rows(CACHE, validated_rows)
+
+        if archive.ENABLED and archive.has_closed_years(
+                ledger_cache.first_cached_date(CACHE)) and archive_data():
+            return sync_data(require_data)
+
+        # Check if there are no readings in the ledger or its archives.
+        if (require_data
+                and ledger_cache.read_aggregates(CACHE).row_count == 0
+                and not ledger_cache.read_summaries(CACHE)):
             print(
                 "Not enough data available."
                 "Please input data before calculating metrics."
             )
-            select_mode()
-        else:
-            # Remove first item (header row).
-            data = data[1:]
-            if col_num == 1:  # Odometer readings column
-                return (validate_int_data(data))
-            elif col_num == 2:  # Fuel quantity column
-                return (validate_float_data(data, col_num))
-            elif col_num == 3:  # Fuel cost column
-                return (validate_float_data(data, col_num))
-            else:
-                print(
-                    "Invalid column number."
-                    "Please contact the developer for assistance."
-                    )
+            return False
+        return True
     except Exception as e:
         print(f"An error occurred: {e}")
-        select_mode()
+        return False
 
 
-def validate_int_data(int_data):
+def archive_data():
     """
-    Function to validate if odometer readings data is integers.
-    Throws a value error message if validation fails.
+    Function to archive the refuels of closed years.
+    Clears the cache once they are moved, as the remaining rows are
+    renumbered.
+    Returns True if refuels were archived. A failure is reported but does
+    not stop the metrics, which are then calculated from the full ledger.
     """
     try:
-        # Attempt to convert all items to integers
-        return [int(item) for item in int_data]
-    except ValueError:
-        print(
-            "Odometer readings data is invalid. "
-            "Please contact the developer for assistance."
-        )
+        archived = archive.archive_closed_years(STORAGE)
+    except Exception as e:
+        print(f"Archiving closed years failed: {e}")
+        return False
+    if archived:
+        print(f"{archived} refuels of closed years archived.")
+        ledger_cache.clear_cache(CACHE)
+    return bool(archived)
 
 
-def validate_float_data(float_data, col_num):
+def validate_data():
     """
-    Function to validate float data.
-    Throws a value error message if an error.
+    Function to load the validated ledger.
+    Calls sync_data() to bring the local cache up to date, then writes the
+    rows cached since the last view to the columnar snapshot.
+    Returns a FuelData snapshot of the cached ledger shared by all metric
+    calculations, its columns read straight from the memory-mapped
+    snapshot, or None if the data could not be validated.
     """
-    try:
-        # Attempt to convert all items to floats
-        return [float(item) for item in float_data]
-    except ValueError:
-        type_data = "Fuel quantity" if col_num == 2 else "Fuel cost"
-        print(
-            f"{type_data} data is invalid. "
-            "Please contact the developer for assistance."
+    if sync_data():
+        try:
+            ledger = snapshot.load_snapshot(CACHE, SNAPSHOT_PATH)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return None
+        return ledger_index.FuelData(*ledger.fuel_columns())
+
+
+def report_ledger_errors(errors):
+    """
+    Function to print every invalid value found in the ledger, with its
+    worksheet row, so they can all be corrected at once.
+    """
+    print(
+        f"The ledger has {len(errors)} invalid values. "
+        "Please correct these rows:"
         )
+    for issue in errors:
+        print(f"Row {issue.row}, {issue.column}: {issue.message}")
 
 
 # Menu Navigation function:
@@ -266,8 +573,8 @@ def navigate_metrics():
     """
     Function to navigate back to the metrics or to mode selection menu.
     Run a while loop until the user selects a valid option.
-    Calls the select_mode() function if user selection is 1.
-    Calls the select_metrics() function if user selection is 2.
+    Returns the mode selection screen if user selection is 1.
+    Returns the metrics selection screen if user selection is 2.
     """
     while True:
         print("To navigate back: \n")
@@ -275,11 +582,9 @@ def navigate_metrics():
         print("2: Select Metrics Menu")
         selection = input("Enter the number of your selected menu \n")
         if selection == "1":
-            select_mode()
-            break
+            return "select_mode"
         elif selection == "2":
-            select_metrics()
-            break
+            return "select_metrics"
         else:
             print("Invalid input. Please try again.")
 
@@ -310,7 +615,7 @@ def fuel_data_input():
     Function to input fueling data.
     Run a while loop until the user inputs valid data.
     Calls the validate_fuel_data() function.
-    Calls the select_mode() function if data entry is successful.
+    Returns the fuel quantity and cost once data entry is successful.
     """
     while True:
         print("Please input your fueling data:")
@@ -333,35 +638,34 @@ def validate_odo_input(odo_data):
     Function to validate odometer readings data input.
     Checks if the data is an integer.
     Checks if the data is greater than the last reading.
-    """
-    if not odo_data.isdigit():
-        print("Odometer readings data must be an integer.")
+    The last reading is kept by the ledger cache running totals, and the
+    sync only reads the rows added since the last one, so the check costs
+    the same however many refuels are stored.
+    Refuels saved but not uploaded yet are checked against too, so readings
+    are still validated offline.
+    """
+    error = validation.odo_error(odo_data)
+    if error:
+        print(error)
         return False
+    elif not sync_data(require_data=False) and JOURNAL.last_odo() is None:
+        print(
+            "Unable to retrieve last odometer reading."
+            "First entry, skipping validation."
+            )
+        return True
     else:
-        try:
-            odo_data_int = int(odo_data)
-            odo_col_data = WORKSHEET.col_values(1)
-
-            if len(odo_col_data) < 2:
-                return True  # First entry, skipping validation.
+        last_odo_data = last_odo_reading()
 
-            last_odo_data = int(odo_col_data[-1])
-
-            if int(odo_data_int) < last_odo_data:
-                print(
-                    "Odometer reading must be greater than the last reading."
-                    )
-                print(f"Last reading: {last_odo_data}")
-                return False
-            else:
-                return True
+        if last_odo_data is None:
+            return True  # First entry, skipping validation.
 
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            print(
-                "Unable to retrieve last odometer reading."
-                "First entry, skipping validation."
-                )
+        error = validation.odo_error(odo_data, last_odo_data)
+        if error:
+            print(error)
+            print(f"Last reading: {last_odo_data}")
+            return False
+        else:
             return True
 
 
@@ -373,37 +677,25 @@ def validate_fuel_data(fuel_quantity, fuel_cost):
     Checks if the data is less than 40 for fuel quantity.
     (40 is the maximum capacity of the fuel tank)
     """
-    try:
-        fuel_quantity_float = float(fuel_quantity)
-        fuel_cost_float = float(fuel_cost)
-
-        if fuel_quantity_float <= 0:
-            print("Fuel quantity must be greater than 0.")
-            return False
-        elif fuel_quantity_float > 40:
-            print("Fuel quantity must not exceed 40.")
-            return False
-        elif fuel_cost_float <= 0:
-            print("Fuel cost must be greater than 0.")
-            return False
-        else:
-            return True
-    except ValueError:
-        print(
-            "Invalid input. Fuel quantity and cost must be numeric values."
-            "Please try again."
-            )
+    error = validation.fuel_error(fuel_quantity, fuel_cost)
+    if error:
+        print(error)
         return False
+    else:
+        return True
 
 
 def confirm_data_input(odo_data, fuel_quantity, fuel_cost):
     """
     Confirms data input.
     Runs a loop until the user confirms the data.
-    Calls select_mode() if data entry is successful.
+    Returns the mode selection screen once the data is saved or cancelled.
+    Returns the data input screen to re-enter the data.
     """
 
-    new_data_input = [odo_data, fuel_quantity, fuel_cost]
+    new_data_input = [
+        odo_data, fuel_quantity, fuel_cost, date.today().isoformat()
+        ]
     while True:
         print("Please confirm your data inputs:")
         print(f"Odometer: {odo_data} km")
@@ -418,32 +710,71 @@ def confirm_data_input(odo_data, fuel_quantity, fuel_cost):
 
         if confirm_data == "1":
             upload_data(new_data_input)
-            select_mode()
-            break
+            return "select_mode"
         elif confirm_data == "2":
-            data_input()
-            break
+            return "data_input"
         elif confirm_data == "3":
             print("Data input cancelled.\n")
-            select_mode()
-            break
+            return "select_mode"
         else:
             print("Invalid input. Please try again.")
 
 
 def upload_data(data):
     """
-    Function to upload data to Google Sheets.
-    Calls the append_row() function to append the data to the Google Sheet.
+    Function to upload data to the storage backend.
+    Calls save_refuels() to save the data to the journal, which uploads it
+    in the background.
+    Returns True once the data is saved.
     """
     try:
         print("Data input confirmed.")
-        print("Uploading data to Google Sheets...")
-        WORKSHEET.append_row(data)
-        print("Data uploaded successfully.\n")
+        save_refuels([data])
+        print("Data saved, uploading in the background.\n")
+        return True
     except Exception as e:
         print(f"An error occurred: {e.args}")
-        select_mode()
+        return False
+
+
+def save_refuels(rows):
+    """
+    Function to save validated refuels.
+    Appends the rows to the journal, which returns once they are on disk.
+    Its flusher uploads them with append_rows() calls, and the next sync
+    adds them to the local cache and its running totals.
+    """
+    JOURNAL.append(rows)
+
+
+def last_odo_reading():
+    """
+    Returns the last odometer reading of the ledger, including the refuels
+    not uploaded yet and the archived years, or None if there is none.
+    """
+    readings = [
+        ledger_cache.read_aggregates(CACHE).last_odo, JOURNAL.last_odo(),
+        ledger_index.opening_odo(ledger_cache.read_summaries(CACHE)),
+        ]
+    readings = [reading for reading in readings if reading is not None]
+    return max(readings) if readings else None
+
+
+def last_refuel():
+    """
+    Returns the last refuel of the ledger as a validated (odo, quantity,
+    cost, date) row, including the refuels not uploaded yet and the
+    archived years, or None if there is none.
+    New refuels are validated against it, so their readings and dates
+    carry on from the whole ledger.
+    """
+    previous = ledger_cache.last_cached_row(CACHE)
+    if previous is None:
+        previous = archive.previous_row(ledger_cache.read_summaries(CACHE))
+    valid_rows, _ = validation.validate_ledger(
+        enumerate(JOURNAL.pending_rows()), previous
+        )
+    return valid_rows[-1] if valid_rows else previous
 
 
 def data_input():
@@ -452,12 +783,65 @@ def data_input():
     Calls the odo_data_input() function to input odometer readings data.
     Calls the fuel_data_input() function to input fueling data.
     Calls the confirm_data_input() function to confirm data input.
+    Returns the next screen selected on confirmation.
     """
     odo_data = odo_data_input()
     fuel_quantity, fuel_cost = fuel_data_input()
-    confirm_data_input(odo_data, fuel_quantity, fuel_cost)
+    return confirm_data_input(odo_data, fuel_quantity, fuel_cost)
+
+
+# Screens of the menu state machine, looked up by the name each returns:
+SCREENS = {
+    "select_mode": select_mode,
+    "select_vehicle": select_vehicle,
+    "select_metrics": select_metrics,
+    "latest_metrics": latest_metrics,
+    "annual_metrics": annual_metrics,
+    "range_metrics": range_metrics,
+    "total_ownership_metrics": total_ownership_metrics,
+    "rolling_metrics": rolling_metrics,
+    "fleet_summary": fleet_summary,
+    "navigate_metrics": navigate_metrics,
+    "data_input": data_input,
+}
+
+
+def main(argv=None):
+    """
+    Function to run the app.
+    Runs the menu state machine: each screen returns the name of the next
+    screen, so navigation runs in a loop with a constant stack depth.
+    With --profile, the storage calls made by each screen are dumped on
+    exit. With --profile-file, they are exported to that file.
+    """
+    parser = argparse.ArgumentParser(description="Car Fuel Metrics App")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="dump the storage call profile on exit"
+        )
+    parser.add_argument(
+        "--profile-file", metavar="FILE",
+        help="export the storage call profile as JSON to FILE"
+        )
+    args = parser.parse_args(argv)
+    open_ledger(storage.VEHICLE)
+
+    print("Welcome to the Car Fuel Metrics App")
+    screen = "select_mode"
+    try:
+        while screen:
+            instrumentation.set_screen(screen)
+            screen = SCREENS[screen]()
+    finally:
+        if not JOURNAL.try_flush():
+            print(
+                f"{len(JOURNAL.pending_rows())} refuels are saved locally "
+                "and will be uploaded on the next start."
+                )
+        if args.profile or args.profile_file:
+            instrumentation.dump_profile(args.profile_file)
 
 
 # Run the app:
-print("Welcome to the Car Fuel Metrics App")
-select_mode()
+if __name__ == "__main__":
+    main()
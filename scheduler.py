@@ -0,0 +1,179 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import instrumentation
+
+
+# Google Sheets API quota, per user and minute, for each bucket. Bursts of
+# up to BURST requests are sent at once, then requests are spaced out to
+# the quota rate.
+READS_PER_MINUTE = int(os.environ.get("CFM_READS_PER_MINUTE", "60"))
+WRITES_PER_MINUTE = int(os.environ.get("CFM_WRITES_PER_MINUTE", "60"))
+BURST = 10
+# Retries of a request rejected with a retryable status, waiting a random
+# delay of up to BASE_BACKOFF * 2 ** attempt seconds, capped at MAX_BACKOFF.
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 32.0
+# Reads are retried on quota errors and server errors. Writes are only
+# retried on quota errors, which Google rejects before applying them, so a
+# retry never appends the same refuel twice.
+RETRY_READ_STATUSES = {429, 500, 502, 503, 504}
+RETRY_WRITE_STATUSES = {429}
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by the threads of the process.
+    Holds up to capacity tokens, refilled at rate_per_minute. Each request
+    takes a token, waiting for the next one if the bucket is empty.
+    """
+
+    def __init__(self, rate_per_minute, capacity=BURST):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                    )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def error_status(error):
+    """Returns the HTTP status of an API error, or None."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def request_label(func, key=None):
+    """
+    Returns the operation, target and cell range of a request for the
+    session profile: from the key of a read, or from the gspread method of
+    a write and the worksheet or spreadsheet it is bound to.
+    """
+    if key is not None:
+        cell_range = key[2] if len(key) > 2 else None
+        if not isinstance(cell_range, str):
+            cell_range = None
+        return key[0], key[1] if len(key) > 1 else None, cell_range
+    method = getattr(func, "func", func)
+    target = getattr(getattr(method, "__self__", None), "title", None)
+    return getattr(method, "__name__", "request"), target, None
+
+
+def retry_delay(error, attempt):
+    """
+    Returns the seconds to wait before retrying a request: the delay asked
+    by the server's Retry-After header, or a jittered exponential backoff.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    retry_after = headers.get("Retry-After") if headers else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), MAX_BACKOFF)
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+class Scheduler:
+    """
+    Request scheduler around the Google Sheets client.
+    Every request waits for a token of its read or write bucket, and
+    requests rejected with a retryable status are retried with backoff.
+    Identical reads made while one is in flight wait for its result instead
+    of sending their own request.
+    """
+
+    def __init__(self, reads_per_minute=READS_PER_MINUTE,
+                 writes_per_minute=WRITES_PER_MINUTE):
+        self.read_bucket = TokenBucket(reads_per_minute)
+        self.write_bucket = TokenBucket(writes_per_minute)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def read(self, key, func, *args):
+        """
+        Function to make a read request, identified by key.
+        Returns the result of func(*args), shared with every identical read
+        started before it completes.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(self.send(
+                self.read_bucket, RETRY_READ_STATUSES, func, *args, key=key
+                ))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+        return future.result()
+
+    def write(self, func, *args):
+        """
+        Function to make a write request. Returns func(*args).
+        Reads started before the write may miss it, so later reads do not
+        wait for them.
+        """
+        result = self.send(
+            self.write_bucket, RETRY_WRITE_STATUSES, func, *args
+            )
+        with self.lock:
+            self.in_flight.clear()
+        return result
+
+    def send(self, bucket, retry_statuses, func, *args, key=None):
+        """
+        Function to send a request within the rate limit of the bucket.
+        Retries it while it fails with one of the retry statuses, up to
+        MAX_RETRIES times, then raises the last error.
+        Each attempt is recorded in the session profile with its status.
+        """
+        op, target, cell_range = request_label(func, key)
+        for attempt in range(MAX_RETRIES + 1):
+            bucket.acquire()
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception as e:
+                status = error_status(e)
+                instrumentation.record_request(
+                    op, target, cell_range, time.perf_counter() - start,
+                    attempt, status, e
+                    )
+                if attempt == MAX_RETRIES or status not in retry_statuses:
+                    raise
+                time.sleep(retry_delay(e, attempt))
+            else:
+                instrumentation.record_request(
+                    op, target, cell_range, time.perf_counter() - start,
+                    attempt, 200
+                    )
+                return result
+
+
+# Scheduler of every Google Sheets request made by this process.
+SHEETS = Scheduler()
@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import archive
+import fleet
+import instrumentation
+import ledger_index
+import metrics_engine
+import rolling
+import storage
+import validation
+
+
+# Metrics service setup:
+HOST = os.environ.get("CFM_SERVICE_HOST", "127.0.0.1")
+PORT = int(os.environ.get("CFM_SERVICE_PORT", "8080"))
+# Seconds a warm ledger is served before it is reloaded, to pick up refuels
+# written by other clients. Refuels posted to the service invalidate it at
+# once.
+CACHE_TTL = float(os.environ.get("CFM_SERVICE_TTL", "60"))
+
+
+class Ledger:
+    """
+    Warm in-memory copy of one vehicle's ledger.
+    Holds the validated snapshot of the live rows, the results of the
+    metrics engine and the year index, both including the archived years,
+    the range index and rolling windows of the whole history, with the
+    refuels of the archived years read again only when they change,
+    so requests are answered without touching the storage until the copy
+    is invalidated by a write or expires.
+    """
+
+    def __init__(self, backend, vehicle):
+        self.storage = backend(vehicle)
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.fuel_data = None
+        self.results = None
+        self.year_index = None
+        self.range_index = None
+        self.rolling = None
+        self.summaries = []
+        self.archived_rows = []
+
+    def load(self):
+        """
+        Function to return the warm snapshot, its metrics, year index,
+        range index and rolling windows.
+        Reloads the ledger from the storage if it was invalidated or has
+        expired.
+        Raises a ValueError if the ledger data is invalid.
+        """
+        with self.lock:
+            return self._load_locked()
+
+    def _load_locked(self):
+        """
+        Returns the warm snapshot, its metrics, year index, range index and
+        rolling windows, reloading them if needed. Must be called with the lock
+        held.
+        """
+        expired = (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at > CACHE_TTL
+            )
+        if expired:
+            summaries = self.storage.read_summaries()
+            if summaries != self.summaries:
+                self.archived_rows = archive.read_archived_rows(
+                    self.storage, summaries
+                    )
+            self.summaries = summaries
+            self.fuel_data = parse_ledger(
+                self.storage.read_rows(), archive.previous_row(summaries)
+                )
+            self.results = metrics_engine.calculate_metrics(
+                zip(*self.fuel_data), summaries=self.summaries
+                )
+            self.year_index = ledger_index.YearIndex(
+                self.fuel_data, self.summaries
+                )
+            self.range_index = ledger_index.RangeIndex(
+                ledger_index.with_archive(self.fuel_data, self.archived_rows)
+                )
+            self.rolling = rolling.RollingMetrics()
+            self.rolling.add_archive(self.archived_rows)
+            self.rolling.add_rows(zip(*self.fuel_data))
+            self.loaded_at = time.monotonic()
+        return (
+            self.fuel_data, self.results, self.year_index, self.range_index,
+            self.rolling
+            )
+
+    def rolling_results(self):
+        """
+        Returns the PeriodMetrics of each rolling window, or None for the
+        windows without refuels.
+        Reading the windows evicts the refuels out of them, so they are
+        read under the lock.
+        """
+        with self.lock:
+            return self._load_locked()[4].results()
+
+    def last_refuel(self):
+        """
+        Returns the last refuel of the ledger as a validated (odo, quantity,
+        cost, date) row, with the date of the last dated refuel, or the
+        last archived refuel, or None. Must be called with the lock held.
+        """
+        fuel_data, _, year_index, _, _ = self._load_locked()
+        if not fuel_data.odo:
+            return archive.previous_row(self.summaries)
+        return (
+            fuel_data.odo[-1], fuel_data.quantity[-1], fuel_data.cost[-1],
+            year_index.dates[-1] or year_index.opening_date
+            )
+
+    def append(self, refuels):
+        """
+        Function to validate and append refuels given as dicts with odo,
+        quantity, cost and optional date fields.
+        Validates them like the rows of the ledger, carried on from its last
+        refuel, so readings and dates never go backwards. Dates must not be
+        in the future.
+        The ledger is read, checked and appended to under the lock, so
+        concurrent requests are validated against each other's refuels.
+        Saves the refuels with a single storage call and invalidates the
+        warm copy.
+        Returns the number of refuels added.
+        Raises a ValueError naming the first invalid refuel.
+        """
+        today = date.today()
+        rows = []
+        for number, refuel in enumerate(refuels, start=1):
+            row = [
+                str(refuel.get(field, "")).strip()
+                for field in ("odo", "quantity", "cost")
+                ]
+            row.append(str(refuel.get("date") or today.isoformat()).strip())
+            error = validation.date_error(row[3], today)
+            if error:
+                raise ValueError(f"Refuel {number}: {error}")
+            rows.append(row)
+        with self.lock:
+            _, issues = validation.validate_ledger(
+                enumerate(rows, start=1), self.last_refuel()
+                )
+            errors = [issue for issue in issues if not issue.warning]
+            if errors:
+                raise ValueError(
+                    f"Refuel {errors[0].row}: {errors[0].message}"
+                    )
+            self.storage.append_rows(rows)
+            self.loaded_at = None
+            return len(rows)
+
+
+def parse_ledger(rows, previous=None):
+    """
+    Function to validate ledger rows into a FuelData snapshot, carried on
+    from the last archived refuel, if any.
+    Raises a ValueError listing the invalid rows, if any.
+    """
+    valid_rows, issues = validation.validate_ledger(
+        enumerate(rows, start=2), previous
+        )
+    invalid_rows = sorted({
+        issue.row for issue in issues if not issue.warning
+        })
+    if invalid_rows:
+        raise ValueError(
+            "Ledger data is invalid in rows "
+            f"{', '.join(str(row) for row in invalid_rows)}."
+            )
+    columns = zip(*valid_rows) if valid_rows else ([], [], [], [])
+    return ledger_index.FuelData(*(list(column) for column in columns))
+
+
+class MetricsService:
+    """
+    Long-running metrics service state, shared by every request: the
+    storage backend, whose Google client is authorised once, and the warm
+    ledger of each vehicle.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or storage.get_backend()
+        self.ledgers = {}
+        self.lock = threading.Lock()
+
+    def ledger(self, vehicle):
+        """Returns the warm ledger of a vehicle, creating it on first use."""
+        with self.lock:
+            if vehicle not in self.ledgers:
+                self.ledgers[vehicle] = Ledger(self.backend, vehicle)
+            return self.ledgers[vehicle]
+
+    def metrics(self, metric_set, vehicle, query):
+        """
+        Function to calculate a metric set of a vehicle from its warm
+        ledger.
+        Raises a ValueError if the metrics cannot be calculated.
+        """
+        ledger = self.ledger(vehicle)
+        _, results, year_index, range_index, _ = ledger.load()
+        if metric_set == "latest":
+            if results["latest_trip_distance"] is None:
+                raise ValueError("Not enough data available.")
+            return metrics_engine.metric_set(
+                results, metrics_engine.LATEST_METRICS
+                )
+        elif metric_set == "total":
+            if not results["total_trip_distance"]:
+                raise ValueError("Not enough data available.")
+            return metrics_engine.metric_set(
+                results, metrics_engine.TOTAL_METRICS
+                )
+        elif metric_set == "annual":
+            years = year_index.years()
+            if "year" in query:
+                years = [int(query["year"])]
+            return {
+                str(year): year_index.year_metrics(year)._asdict()
+                for year in years if year in year_index.years()
+                }
+        elif metric_set == "range":
+            if "from_odo" in query and "to_odo" in query:
+                metrics = range_index.odo_range_metrics(
+                    int(query["from_odo"]), int(query["to_odo"])
+                    )
+            elif "from_date" in query and "to_date" in query:
+                metrics = range_index.date_range_metrics(
+                    query["from_date"], query["to_date"]
+                    )
+            else:
+                raise ValueError(
+                    "Range metrics need from_odo and to_odo, "
+                    "or from_date and to_date."
+                    )
+            return metrics._asdict() if metrics else None
+        elif metric_set == "rolling":
+            return {
+                name: metrics._asdict() if metrics else None
+                for name, metrics in ledger.rolling_results().items()
+                }
+        raise LookupError(f"Unknown metrics '{metric_set}'.")
+
+
+def parse_query(url):
+    """Returns the query parameters of a URL, keeping the last of repeats."""
+    return {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/JSON endpoints of the metrics service:
+    GET  /metrics/{latest,annual,range,total,rolling}?vehicle=NAME&...
+    GET  /fleet
+    GET  /vehicles
+    GET  /profile, the storage calls made by each endpoint
+    POST /refuels?vehicle=NAME with a refuel object or a list of them
+    """
+
+    service = None
+
+    def do_GET(self):
+        """Handles the metrics, fleet, vehicles and profile endpoints."""
+        url = urlparse(self.path)
+        query = parse_query(url)
+        vehicle = query.get("vehicle", storage.VEHICLE)
+        parts = url.path.strip("/").split("/")
+        instrumentation.set_screen(f"GET {url.path}")
+        try:
+            if len(parts) == 2 and parts[0] == "metrics":
+                result = {
+                    "vehicle": vehicle,
+                    parts[1]: self.service.metrics(parts[1], vehicle, query),
+                    }
+            elif parts == ["fleet"]:
+                summaries, skipped = fleet.fleet_summary(self.service.backend)
+                result = {
+                    "ranking": [summary._asdict() for summary in summaries],
+                    "not_enough_data": skipped,
+                    }
+            elif parts == ["vehicles"]:
+                result = self.service.backend.list_vehicles()
+            elif parts == ["profile"]:
+                result = instrumentation.SESSION.summary()
+            else:
+                raise LookupError(f"Unknown endpoint '{url.path}'.")
+        except LookupError as e:
+            return self.send_json(404, {"error": str(e)})
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": f"An error occurred: {e}"})
+        self.send_json(200, result)
+
+    def do_POST(self):
+        """Handles the refuels endpoint, the service's upload_data()."""
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/refuels":
+            return self.send_json(
+                404, {"error": f"Unknown endpoint '{url.path}'."}
+                )
+        query = parse_query(url)
+        vehicle = query.get("vehicle", storage.VEHICLE)
+        instrumentation.set_screen(f"POST {url.path}")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            refuels = json.loads(self.rfile.read(length) or b"null")
+            if isinstance(refuels, dict):
+                refuels = [refuels]
+            if not isinstance(refuels, list) or not all(
+                    isinstance(refuel, dict) for refuel in refuels):
+                raise ValueError(
+                    "Send a refuel object or a list of refuel objects."
+                    )
+            added = self.service.ledger(vehicle).append(refuels)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            return self.send_json(500, {"error": f"An error occurred: {e}"})
+        self.send_json(201, {"vehicle": vehicle, "added": added})
+
+    def send_json(self, status, body):
+        """Sends a JSON response."""
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main(argv=None):
+    """
+    Command line entry point starting the service:
+    python3 service.py --port 8080
+    """
+    parser = argparse.ArgumentParser(description="Car Fuel Metrics service")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args(argv)
+
+    RequestHandler.service = MetricsService()
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print(f"Serving Car Fuel Metrics on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import mmap
+import os
+import re
+import struct
+from array import array
+from collections.abc import Sequence
+
+import ledger_cache
+
+
+# Columnar snapshot setup:
+SNAPSHOT_FILE = os.environ.get("CFM_SNAPSHOT_FILE", "fuel_snapshot.bin")
+MAGIC = b"CFMSNAP\0"
+VERSION = 1
+# Rows reserved in a new snapshot, so later refuels are written in place.
+MIN_CAPACITY = 1024
+
+# Columns of the snapshot, with their array type codes: odometer readings
+# as int64, fuel quantity and cost as float64, and dates as int32 YYYYMMDD
+# numbers, 0 for undated refuels.
+SCHEMA = [("odo", "q"), ("quantity", "d"), ("cost", "d"), ("dates", "i")]
+
+# Header: magic, version, column count, row count, row capacity and the
+# generation of the ledger cache the rows come from, then the name and
+# type code of each column.
+HEADER = struct.Struct("<8sHHQQQ")
+COLUMN = struct.Struct("<15sc")
+# Columns start on an 8 byte boundary, so each one can be cast in place.
+HEADER_SIZE = -(-(HEADER.size + COLUMN.size * len(SCHEMA)) // 8) * 8
+
+
+def snapshot_path(vehicle):
+    """
+    Returns the snapshot file of a vehicle's ledger, named after the
+    vehicle next to SNAPSHOT_FILE.
+    """
+    root, ext = os.path.splitext(SNAPSHOT_FILE)
+    return f"{root}-{re.sub(r'[^A-Za-z0-9_-]', '_', vehicle)}{ext}"
+
+
+def encode_date(refuel_date):
+    """Returns a YYYY-MM-DD date as a YYYYMMDD number, or 0 if undated."""
+    return int(refuel_date.replace("-", "")) if refuel_date else 0
+
+
+def decode_date(number):
+    """Returns a YYYYMMDD number as a YYYY-MM-DD date, or "" if 0."""
+    if not number:
+        return ""
+    year, month, day = number // 10000, number // 100 % 100, number % 100
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+class DateColumn(Sequence):
+    """
+    Read-only view of the dates column, decoding each date when it is read.
+    """
+
+    def __init__(self, numbers):
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DateColumn(self.numbers[index])
+        return decode_date(self.numbers[index])
+
+
+class Snapshot:
+    """
+    Columnar snapshot of a validated ledger.
+    Each column is a fixed-width typed array, read through a memoryview
+    cast over the buffer, usually a memory-mapped snapshot file. Metrics
+    read the values straight from the mapped pages, so loading the ledger
+    copies nothing and its values are only boxed as they are used.
+    Raises a ValueError if the buffer is not a snapshot of this schema.
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if len(view) < HEADER_SIZE:
+            raise ValueError("Snapshot header is truncated.")
+        (magic, version, column_count, self.row_count, self.capacity,
+         self.generation) = HEADER.unpack_from(view)
+        schema = [
+            (name.rstrip(b"\0").decode(), typecode.decode())
+            for name, typecode in COLUMN.iter_unpack(
+                view[HEADER.size:HEADER.size + COLUMN.size * column_count]
+                )
+            ]
+        if magic != MAGIC or version != VERSION or schema != SCHEMA:
+            raise ValueError("Snapshot format is not supported.")
+        if len(view) < column_offset(len(SCHEMA), self.capacity):
+            raise ValueError("Snapshot columns are truncated.")
+
+        self.columns = {}
+        for col, (name, typecode) in enumerate(SCHEMA):
+            start = column_offset(col, self.capacity)
+            end = start + self.row_count * array(typecode).itemsize
+            self.columns[name] = view[start:end].cast(typecode)
+
+    def row(self, index):
+        """Returns a row as an (odo, quantity, cost, date) tuple."""
+        return (
+            self.columns["odo"][index], self.columns["quantity"][index],
+            self.columns["cost"][index],
+            decode_date(self.columns["dates"][index]),
+            )
+
+    def fuel_columns(self):
+        """
+        Returns the odometer, fuel quantity, fuel cost and date columns,
+        ready to be passed to the metric calculations.
+        """
+        return (
+            self.columns["odo"], self.columns["quantity"],
+            self.columns["cost"], DateColumn(self.columns["dates"]),
+            )
+
+
+def column_offset(col, capacity):
+    """Returns the byte offset of a column in a snapshot of the capacity."""
+    return HEADER_SIZE + capacity * sum(
+        array(typecode).itemsize for _, typecode in SCHEMA[:col]
+        )
+
+
+def pack_header(row_count, capacity, generation):
+    """Returns the header of a snapshot, padded to HEADER_SIZE."""
+    header = HEADER.pack(
+        MAGIC, VERSION, len(SCHEMA), row_count, capacity, generation
+        ) + b"".join(
+            COLUMN.pack(name.encode(), typecode.encode())
+            for name, typecode in SCHEMA
+            )
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+def column_arrays(rows):
+    """
+    Function to convert (odo, quantity, cost, date) rows to one typed array
+    per column.
+    """
+    arrays = [array(typecode) for _, typecode in SCHEMA]
+    for odo_data, fuel_quantity, fuel_cost, refuel_date in rows:
+        arrays[0].append(odo_data)
+        arrays[1].append(fuel_quantity)
+        arrays[2].append(fuel_cost)
+        arrays[3].append(encode_date(refuel_date))
+    return arrays
+
+
+def build_snapshot(rows, generation):
+    """
+    Function to build a snapshot of validated ledger rows.
+    Reserves room for as many rows again, and at least MIN_CAPACITY, so
+    appending refuels rarely needs a rebuild.
+    Returns the snapshot as a bytearray.
+    """
+    arrays = column_arrays(rows)
+    capacity = max(MIN_CAPACITY, 2 * len(rows))
+    buffer = bytearray(pack_header(len(rows), capacity, generation))
+    for values in arrays:
+        buffer += values.tobytes()
+        buffer += bytes((capacity - len(values)) * values.itemsize)
+    return buffer
+
+
+def write_snapshot(path, buffer):
+    """
+    Function to write a snapshot file, replacing any older one atomically.
+    Processes still reading the older file keep their mapping of it.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(buffer)
+    os.replace(temp_path, path)
+
+
+def append_snapshot(path, snapshot, rows):
+    """
+    Function to write new rows into the free capacity of a snapshot file.
+    The values are written after the rows already in each column, then the
+    header, so readers never see a row count covering unwritten rows.
+    """
+    row_count = snapshot.row_count + len(rows)
+    with open(path, "r+b") as snapshot_file:
+        for col, values in enumerate(column_arrays(rows)):
+            snapshot_file.seek(
+                column_offset(col, snapshot.capacity)
+                + snapshot.row_count * values.itemsize
+                )
+            snapshot_file.write(values.tobytes())
+        snapshot_file.flush()
+        snapshot_file.seek(0)
+        snapshot_file.write(
+            pack_header(row_count, snapshot.capacity, snapshot.generation)
+            )
+
+
+def open_snapshot(path):
+    """
+    Function to memory-map a snapshot file read-only.
+    Returns the Snapshot, or None if the file is missing or not a valid
+    snapshot.
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            mapping = mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return Snapshot(mapping)
+    except (OSError, ValueError):
+        return None
+
+
+def load_snapshot(conn, path=None):
+    """
+    Function to bring the snapshot of a ledger up to date with its cache.
+    The last snapshot row is compared with the same cached row, like the
+    cache sync does with the worksheet. If they match, only the rows cached
+    since are written, in place. Otherwise, or if the cache was cleared
+    since, the snapshot is rebuilt from every cached row.
+    Without a path, the snapshot is only built in memory.
+    Returns the up to date Snapshot.
+    """
+    generation = ledger_cache.cache_generation(conn)
+    snapshot = open_snapshot(path) if path else None
+    if (snapshot is not None and snapshot.row_count
+            and snapshot.generation == generation):
+        tail = ledger_cache.cached_rows(conn, snapshot.row_count - 1)
+        if tail and tuple(tail[0]) == snapshot.row(-1):
+            new_rows = tail[1:]
+            if not new_rows:
+                return snapshot
+            if snapshot.row_count + len(new_rows) <= snapshot.capacity:
+                append_snapshot(path, snapshot, new_rows)
+                snapshot = open_snapshot(path)
+                if snapshot is not None:
+                    return snapshot
+
+    buffer = build_snapshot(ledger_cache.cached_rows(conn), generation)
+    if not path:
+        return Snapshot(buffer)
+    write_snapshot(path, buffer)
+    return open_snapshot(path) or Snapshot(buffer)
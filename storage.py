@@ -0,0 +1,650 @@
+import asyncio
+import os
+import re
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
+from functools import cached_property, lru_cache, partial
+
+import instrumentation
+import scheduler
+
+
+# Google Sheets API setup:
+SCOPE = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.file",
+    "https://www.googleapis.com/auth/drive"
+    ]
+
+SPREADSHEET_NAME = 'ci_car_fuel_metrics'
+WORKSHEET_NAME = 'fuel_data'
+SQLITE_FILE = os.environ.get("CFM_SQLITE_FILE", "fuel_data.sqlite3")
+
+# Each vehicle of the fleet has its own ledger, named after the vehicle.
+# The vehicle used by the app is selected with CFM_VEHICLE.
+VEHICLE = os.environ.get("CFM_VEHICLE", WORKSHEET_NAME)
+# Maximum concurrent storage requests, and size of the pool of keep-alive
+# HTTP connections they share.
+POOL_SIZE = 8
+
+# Ledger columns, in worksheet order. Refuels saved before dates were
+# recorded have an empty date.
+LEDGER_COLUMNS = ["odo", "quantity", "cost", "date"]
+LEDGER_HEADER = ["Odometer", "Fuel Quantity", "Fuel Cost", "Date"]
+
+# Closed years of a ledger are moved to an archive ledger per year, named
+# after the vehicle and the year, which stores a summary row of its totals.
+# In an archive worksheet, the summary row sits next to the refuels. It
+# also holds the last archived refuel, whose reading is last_odo, so the
+# rows of an interrupted run can be told from the refuels after them.
+ArchiveSummary = namedtuple(
+    "ArchiveSummary",
+    ["year", "refuels", "first_odo", "last_odo", "fuel_quantity",
+     "fuel_cost", "last_quantity", "last_cost", "last_date"]
+    )
+SUMMARY_HEADER = [
+    "Refuels", "First Odometer", "Last Odometer", "Fuel Quantity",
+    "Fuel Cost", "Last Fuel Quantity", "Last Fuel Cost", "Last Date"
+    ]
+SUMMARY_RANGE = "F2:M2"
+ARCHIVE_PATTERN = re.compile(r"(.+) archive (\d{4})")
+
+
+def archive_name(vehicle, year):
+    """Returns the name of the archive ledger of a vehicle's year."""
+    return f"{vehicle} archive {year}"
+
+
+def parse_summary(year, values):
+    """
+    Returns the ArchiveSummary of a year from its stored values, or None if
+    the summary row is missing or incomplete.
+    """
+    try:
+        (refuels, first_odo, last_odo, fuel_quantity, fuel_cost,
+         last_quantity, last_cost, *last_date) = values
+        return ArchiveSummary(
+            year, int(refuels), int(first_odo), int(last_odo),
+            float(fuel_quantity), float(fuel_cost), float(last_quantity),
+            float(last_cost), "".join(last_date)
+            )
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Function to authorise the gspread client on first use.
+    The client is reused for every later call.
+    Its access token is shared through the token cache, so processes
+    started while the token is valid skip the token exchange.
+    The Google libraries are imported here so that starting the app, or
+    using another backend, does not pay for loading them.
+    """
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+
+    import token_cache
+
+    creds = Credentials.from_service_account_file('creds.json')
+    client = gspread.authorize(
+        token_cache.share_token(creds.with_scopes(SCOPE))
+        )
+    # Concurrent requests reuse the authorised session's open connections.
+    client.http_client.session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        )
+    return client
+
+
+@lru_cache(maxsize=None)
+def get_spreadsheet(name=SPREADSHEET_NAME):
+    """Function to open the spreadsheet on first use and reuse it later."""
+    return scheduler.SHEETS.read(("open", name), get_client().open, name)
+
+
+class Storage:
+    """
+    Interface shared by the storage backends.
+    Each instance holds the ledger of one vehicle, as rows of strings in
+    LEDGER_COLUMNS order.
+    """
+
+    name = None
+    persistent = True
+    # Backends reading the ledgers of a whole fleet with a single call.
+    batch_reads = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every storage call of every backend is recorded in the session
+        # profile.
+        instrumentation.trace_storage(cls)
+
+    def __init__(self, vehicle=VEHICLE):
+        self.vehicle = vehicle
+
+    def read_rows(self, start=0):
+        """Returns the ledger rows from the given 0-based offset."""
+        raise NotImplementedError
+
+    def append_row(self, row):
+        """Appends one ledger row."""
+        self.append_rows([row])
+
+    def append_rows(self, rows):
+        """Appends several ledger rows."""
+        raise NotImplementedError
+
+    def archive_rows(self, year, rows, summary):
+        """
+        Appends ledger rows to the archive of the year, creating it if
+        needed, and stores its updated ArchiveSummary.
+        """
+        raise NotImplementedError
+
+    def delete_rows(self, count):
+        """Deletes the first count ledger rows."""
+        raise NotImplementedError
+
+    def read_archive_rows(self, years):
+        """Returns a dict of the rows of the archive of each given year."""
+        raise NotImplementedError
+
+    def read_summaries(self):
+        """Returns the ArchiveSummary of each archived year, by year."""
+        return self.read_archive_summaries([self.vehicle])[self.vehicle]
+
+    @classmethod
+    def list_vehicles(cls):
+        """Returns the names of the vehicles with a ledger."""
+        raise NotImplementedError
+
+    @classmethod
+    def read_archive_summaries(cls, vehicles):
+        """
+        Returns a dict of the ArchiveSummary of each archived year of each
+        vehicle, by year.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def read_fleet(cls, vehicles):
+        """
+        Function to read the ledgers of several vehicles.
+        Reads them concurrently through the async storage layer, so a fleet
+        costs about as much as its slowest vehicle.
+        Returns a dict of the rows of each vehicle.
+        """
+        import async_storage
+
+        return asyncio.run(async_storage.read_fleet(cls, vehicles))
+
+
+class SheetsStorage(Storage):
+    """
+    Storage backend reading and writing the ledger in Google Sheets.
+    Each vehicle has its own worksheet in the spreadsheet.
+    Row 1 of the worksheet is the header, the ledger starts on row 2.
+    No API call is made until the worksheet is first read or written.
+    Every API call goes through the request scheduler, which keeps to the
+    quota and retries the calls rejected by it.
+    """
+
+    name = "sheets"
+    batch_reads = True
+
+    def __init__(self, vehicle=VEHICLE, spreadsheet=SPREADSHEET_NAME):
+        super().__init__(vehicle)
+        self.spreadsheet_name = spreadsheet
+        self.source = f"{spreadsheet}/{vehicle}"
+
+    @cached_property
+    def worksheet(self):
+        """The gspread worksheet, opened on first use."""
+        spreadsheet = get_spreadsheet(self.spreadsheet_name)
+        return scheduler.SHEETS.read(
+            ("worksheet", self.source), spreadsheet.worksheet, self.vehicle
+            )
+
+    def read_rows(self, start=0):
+        """
+        Returns the ledger rows from the given 0-based offset to the end as
+        lists of strings, in a single API call.
+        """
+        cell_range = f"A{start + 2}:D"
+        return scheduler.SHEETS.read(
+            ("get", self.source, cell_range), self.worksheet.get, cell_range
+            )
+
+    def append_row(self, row):
+        """Appends one ledger row to the worksheet."""
+        scheduler.SHEETS.write(self.worksheet.append_row, row)
+
+    def append_rows(self, rows):
+        """Appends several ledger rows to the worksheet in one API call."""
+        scheduler.SHEETS.write(self.worksheet.append_rows, rows)
+
+    def archive_rows(self, year, rows, summary):
+        """
+        Appends ledger rows to the archive worksheet of the year, creating
+        it if needed.
+        The rows and the summary row are written by a single batch update,
+        so the summary always matches the archived rows.
+        """
+        from gspread.exceptions import WorksheetNotFound
+
+        title = archive_name(self.vehicle, year)
+        spreadsheet = get_spreadsheet(self.spreadsheet_name)
+        try:
+            worksheet = scheduler.SHEETS.read(
+                ("worksheet", f"{self.spreadsheet_name}/{title}"),
+                spreadsheet.worksheet, title
+                )
+        except WorksheetNotFound:
+            worksheet = scheduler.SHEETS.write(
+                spreadsheet.add_worksheet, title, len(rows) + 1,
+                len(LEDGER_HEADER) + 1 + len(SUMMARY_HEADER)
+                )
+            scheduler.SHEETS.write(partial(
+                worksheet.update,
+                values=[LEDGER_HEADER + [""] + SUMMARY_HEADER],
+                range_name="A1:M1"
+                ))
+        # The summary counts the refuels already archived, so the new rows
+        # go after them.
+        first_row = summary.refuels - len(rows) + 2
+        last_row = summary.refuels + 1
+        if last_row > worksheet.row_count:
+            scheduler.SHEETS.write(
+                worksheet.add_rows, last_row - worksheet.row_count
+                )
+        scheduler.SHEETS.write(worksheet.batch_update, [
+            {"range": f"A{first_row}:D{last_row}", "values": rows},
+            {"range": SUMMARY_RANGE, "values": [list(summary[1:])]},
+            ])
+
+    def delete_rows(self, count):
+        """Deletes the first count ledger rows of the worksheet."""
+        if count:
+            scheduler.SHEETS.write(
+                self.worksheet.delete_rows, 2, count + 1
+                )
+
+    def read_archive_rows(self, years):
+        """
+        Function to read the rows of the archive worksheets of the given
+        years, with a single batch get API call.
+        Returns a dict of the rows of each year.
+        """
+        if not years:
+            return {}
+        ranges = [
+            "'{}'!A2:D".format(
+                archive_name(self.vehicle, year).replace("'", "''")
+                )
+            for year in years
+            ]
+        spreadsheet = get_spreadsheet(self.spreadsheet_name)
+        response = scheduler.SHEETS.read(
+            ("batch_get", spreadsheet.id, tuple(ranges)),
+            spreadsheet.values_batch_get, ranges
+            )
+        return {
+            year: value_range.get("values", [])
+            for year, value_range in zip(years, response["valueRanges"])
+            }
+
+    @classmethod
+    def list_vehicles(cls):
+        """
+        Returns the titles of the worksheets in the spreadsheet, except the
+        archive worksheets.
+        """
+        return [
+            title for title in cls.list_worksheets()
+            if not ARCHIVE_PATTERN.fullmatch(title)
+            ]
+
+    @classmethod
+    def list_worksheets(cls):
+        """Returns the titles of every worksheet in the spreadsheet."""
+        spreadsheet = get_spreadsheet()
+        return [
+            worksheet.title for worksheet in scheduler.SHEETS.read(
+                ("worksheets", spreadsheet.id), spreadsheet.worksheets
+                )
+            ]
+
+    @classmethod
+    def read_archive_summaries(cls, vehicles):
+        """
+        Function to read the summary rows of the archive worksheets of
+        several vehicles, with a single batch get API call.
+        Returns a dict of the ArchiveSummary of each vehicle's archived
+        years, by year.
+        """
+        summaries = {vehicle: [] for vehicle in vehicles}
+        archives = []
+        for title in cls.list_worksheets():
+            match = ARCHIVE_PATTERN.fullmatch(title)
+            if match and match.group(1) in summaries:
+                archives.append((match.group(1), int(match.group(2)), title))
+        if not archives:
+            return summaries
+        ranges = [
+            "'{}'!{}".format(title.replace("'", "''"), SUMMARY_RANGE)
+            for _, _, title in archives
+            ]
+        spreadsheet = get_spreadsheet()
+        response = scheduler.SHEETS.read(
+            ("batch_get", spreadsheet.id, tuple(ranges)),
+            spreadsheet.values_batch_get, ranges
+            )
+        for (vehicle, year, _), value_range in zip(
+                archives, response["valueRanges"]):
+            values = value_range.get("values", [[]])[0]
+            summary = parse_summary(year, values)
+            if summary is not None:
+                summaries[vehicle].append(summary)
+        for vehicle_summaries in summaries.values():
+            vehicle_summaries.sort()
+        return summaries
+
+    @classmethod
+    def read_fleet(cls, vehicles):
+        """
+        Function to read the ledgers of several vehicles.
+        Reads every worksheet with a single batch get API call.
+        Returns a dict of the rows of each vehicle.
+        """
+        if not vehicles:
+            return {}
+        ranges = [
+            "'{}'!A2:D".format(vehicle.replace("'", "''"))
+            for vehicle in vehicles
+            ]
+        spreadsheet = get_spreadsheet()
+        response = scheduler.SHEETS.read(
+            ("batch_get", spreadsheet.id, tuple(ranges)),
+            spreadsheet.values_batch_get, ranges
+            )
+        return {
+            vehicle: value_range.get("values", [])
+            for vehicle, value_range in zip(
+                vehicles, response["valueRanges"]
+                )
+            }
+
+
+# Table of the summary rows of the archive tables in the SQLite database.
+SUMMARY_TABLE = '"archive_summaries"'
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage backend keeping the ledger in a local SQLite database.
+    Each vehicle has its own table in the database.
+    Values are stored as entered, like in the worksheet, and are validated
+    when they are read.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, vehicle=VEHICLE, path=SQLITE_FILE):
+        super().__init__(vehicle)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.table = self.create_table(vehicle)
+        columns = [
+            column[1] for column in
+            self.conn.execute(f"PRAGMA table_info({self.table})")
+            ]
+        if "date" not in columns:
+            self.conn.execute(
+                f"ALTER TABLE {self.table} ADD COLUMN date TEXT DEFAULT ''"
+                )
+        self.conn.commit()
+        self.source = f"sqlite:{os.path.abspath(path)}/{vehicle}"
+
+    def create_table(self, name):
+        """
+        Function to create the table of a ledger if it does not exist.
+        Returns its quoted name.
+        """
+        table = '"{}"'.format(name.replace('"', '""'))
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "row INTEGER PRIMARY KEY, odo TEXT, quantity TEXT, cost TEXT, "
+            "date TEXT DEFAULT '')"
+            )
+        return table
+
+    def read_rows(self, start=0):
+        """Returns the ledger rows from the given 0-based offset."""
+        return [
+            list(row) for row in self.conn.execute(
+                f"SELECT odo, quantity, cost, date FROM {self.table} "
+                "ORDER BY row LIMIT -1 OFFSET ?", (start,)
+                )
+            ]
+
+    def append_rows(self, rows):
+        """Appends several ledger rows to the database in one transaction."""
+        self.conn.executemany(
+            f"INSERT INTO {self.table} (odo, quantity, cost, date) "
+            "VALUES (?, ?, ?, ?)",
+            [_pad_row(row) for row in rows]
+            )
+        self.conn.commit()
+
+    def archive_rows(self, year, rows, summary):
+        """
+        Appends ledger rows to the archive table of the year and stores its
+        summary row, in one transaction.
+        """
+        table = self.create_table(archive_name(self.vehicle, year))
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {SUMMARY_TABLE} ("
+            "vehicle TEXT, year INTEGER, refuels INTEGER, first_odo INTEGER, "
+            "last_odo INTEGER, fuel_quantity REAL, fuel_cost REAL, "
+            "last_quantity REAL, last_cost REAL, last_date TEXT, "
+            "PRIMARY KEY (vehicle, year))"
+            )
+        self.conn.executemany(
+            f"INSERT INTO {table} (odo, quantity, cost, date) "
+            "VALUES (?, ?, ?, ?)",
+            [_pad_row(row) for row in rows]
+            )
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {SUMMARY_TABLE} "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.vehicle, *summary)
+            )
+        self.conn.commit()
+
+    def delete_rows(self, count):
+        """Deletes the first count ledger rows of the table."""
+        self.conn.execute(
+            f"DELETE FROM {self.table} WHERE row IN ("
+            f"SELECT row FROM {self.table} ORDER BY row LIMIT ?)", (count,)
+            )
+        self.conn.commit()
+
+    def read_archive_rows(self, years):
+        """Returns a dict of the rows of the archive table of each year."""
+        archives = {}
+        for year in years:
+            name = archive_name(self.vehicle, year)
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?", (name,)
+                ).fetchone()
+            if not exists:
+                archives[year] = []
+                continue
+            table = '"{}"'.format(name.replace('"', '""'))
+            archives[year] = [
+                list(row) for row in self.conn.execute(
+                    f"SELECT odo, quantity, cost, date FROM {table} "
+                    "ORDER BY row"
+                    )
+                ]
+        return archives
+
+    @classmethod
+    def list_vehicles(cls, path=SQLITE_FILE):
+        """
+        Returns the names of the tables in the database, except the archive
+        tables.
+        """
+        with closing(sqlite3.connect(path)) as conn:
+            return [
+                name for (name,) in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "ORDER BY name"
+                    )
+                if name != SUMMARY_TABLE.strip('"')
+                and not ARCHIVE_PATTERN.fullmatch(name)
+                ]
+
+    @classmethod
+    def read_archive_summaries(cls, vehicles, path=SQLITE_FILE):
+        """
+        Returns a dict of the ArchiveSummary of each vehicle's archived
+        years, by year.
+        """
+        summaries = {vehicle: [] for vehicle in vehicles}
+        with closing(sqlite3.connect(path)) as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?", (SUMMARY_TABLE.strip('"'),)
+                ).fetchone()
+            if not exists:
+                return summaries
+            for vehicle, *values in conn.execute(
+                    f"SELECT * FROM {SUMMARY_TABLE} ORDER BY vehicle, year"):
+                if vehicle in summaries:
+                    summaries[vehicle].append(ArchiveSummary(*values))
+        return summaries
+
+
+# Ledgers of the in-memory backend, and the summaries of their archives,
+# shared by every instance in a process.
+MEMORY_LEDGERS = {}
+MEMORY_SUMMARIES = {}
+
+
+class MemoryStorage(Storage):
+    """
+    Storage backend keeping the ledger in a Python list.
+    Needs no network access or credentials, which makes it suitable for
+    load tests and benchmarks of the whole menu flow.
+    """
+
+    name = "memory"
+    persistent = False
+
+    def __init__(self, vehicle=VEHICLE, rows=None):
+        super().__init__(vehicle)
+        if rows is not None or vehicle not in MEMORY_LEDGERS:
+            MEMORY_LEDGERS[vehicle] = [_pad_row(row) for row in rows or []]
+        self.rows = MEMORY_LEDGERS[vehicle]
+        self.source = f"memory:{vehicle}"
+
+    def read_rows(self, start=0):
+        """Returns the ledger rows from the given 0-based offset."""
+        return [list(row) for row in self.rows[start:]]
+
+    def append_rows(self, rows):
+        """Appends several ledger rows to the list."""
+        self.rows.extend(_pad_row(row) for row in rows)
+
+    def archive_rows(self, year, rows, summary):
+        """
+        Appends ledger rows to the archive list of the year and stores its
+        summary.
+        """
+        MEMORY_LEDGERS.setdefault(archive_name(self.vehicle, year), []).extend(
+            _pad_row(row) for row in rows
+            )
+        MEMORY_SUMMARIES[(self.vehicle, year)] = summary
+
+    def delete_rows(self, count):
+        """Deletes the first count ledger rows of the list."""
+        del self.rows[:count]
+
+    def read_archive_rows(self, years):
+        """Returns a dict of the rows of the archive list of each year."""
+        return {
+            year: [
+                list(row) for row in MEMORY_LEDGERS.get(
+                    archive_name(self.vehicle, year), []
+                    )
+                ]
+            for year in years
+            }
+
+    @classmethod
+    def list_vehicles(cls):
+        """Returns the names of the in-memory ledgers, except archives."""
+        return sorted(
+            name for name in MEMORY_LEDGERS
+            if not ARCHIVE_PATTERN.fullmatch(name)
+            )
+
+    @classmethod
+    def read_archive_summaries(cls, vehicles):
+        """
+        Returns a dict of the ArchiveSummary of each vehicle's archived
+        years, by year.
+        """
+        return {
+            vehicle: sorted(
+                summary for (name, _), summary in MEMORY_SUMMARIES.items()
+                if name == vehicle
+                )
+            for vehicle in vehicles
+            }
+
+
+def _pad_row(row):
+    """Converts a ledger row to strings, with an empty date if missing."""
+    values = [str(value) for value in row[:len(LEDGER_COLUMNS)]]
+    return values + [""] * (len(LEDGER_COLUMNS) - len(values))
+
+
+BACKENDS = {
+    "sheets": SheetsStorage,
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
+
+
+def get_backend(name=None):
+    """
+    Function to look up the storage backend class selected by
+    configuration.
+    Uses the CFM_STORAGE environment variable, defaulting to Google Sheets.
+    Raises a ValueError for an unknown backend name.
+    """
+    name = name or os.environ.get("CFM_STORAGE", "sheets")
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown storage backend '{name}'. "
+            f"Choose one of: {', '.join(BACKENDS)}."
+            ) from None
+
+
+def get_storage(name=None, vehicle=VEHICLE):
+    """
+    Function to create the storage of a vehicle's ledger, with the backend
+    selected by configuration.
+    """
+    return get_backend(name)(vehicle)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the root of the repository.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import storage  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolated_ledgers(tmp_path, monkeypatch):
+    """
+    Runs each test in its own directory, for the lock and journal files,
+    with empty in-memory ledgers and archives.
+    """
+    monkeypatch.chdir(tmp_path)
+    storage.MEMORY_LEDGERS.clear()
+    storage.MEMORY_SUMMARIES.clear()
+    yield
+    storage.MEMORY_LEDGERS.clear()
+    storage.MEMORY_SUMMARIES.clear()
@@ -0,0 +1,88 @@
+from datetime import date
+
+import archive
+import storage
+
+
+def archived_rows(vehicle, year):
+    """Returns the rows of a vehicle's archive of the year."""
+    return storage.MEMORY_LEDGERS.get(storage.archive_name(vehicle, year), [])
+
+
+def test_rollover_moves_closed_years_to_their_archives():
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2024-06-01"],
+        ["1500", "30", "45", "2024-12-01"],
+        ["2000", "20", "32", "2025-03-01"],
+        ["2600", "40", "60", "2026-01-05"],
+        ])
+
+    assert archive.archive_closed_years(ledger, date(2026, 2, 1)) == 3
+    assert ledger.read_rows() == [["2600", "40", "60", "2026-01-05"]]
+    assert len(archived_rows("car", 2024)) == 2
+    assert len(archived_rows("car", 2025)) == 1
+
+    summaries = ledger.read_summaries()
+    assert [summary.year for summary in summaries] == [2024, 2025]
+    assert summaries[0] == storage.ArchiveSummary(
+        2024, 2, 1000, 1500, 60.0, 90.0, 30.0, 45.0, "2024-12-01"
+        )
+    assert archive.previous_row(summaries) == (2000, 20.0, 32.0, "2025-03-01")
+
+
+def test_current_year_is_not_archived():
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2026-01-05"],
+        ])
+
+    assert archive.archive_closed_years(ledger, date(2026, 2, 1)) == 0
+    assert len(ledger.read_rows()) == 1
+    assert ledger.read_summaries() == []
+
+
+def test_invalid_ledger_is_not_archived():
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2025-06-01"],
+        ["900", "30", "45", "2025-07-01"],
+        ])
+
+    assert archive.archive_closed_years(ledger, date(2026, 2, 1)) == 0
+    assert len(ledger.read_rows()) == 2
+    assert archived_rows("car", 2025) == []
+
+
+def test_interrupted_run_is_completed_without_duplicates():
+    rows = [
+        ["1000", "30", "45", "2025-06-01"],
+        ["1500", "30", "45", "2025-12-30"],
+        ["2000", "20", "32", "2026-01-05"],
+        ]
+    ledger = storage.MemoryStorage("car", rows)
+    # A run that stopped after writing the archive, before deleting rows.
+    valid_rows = [(1000, 30.0, 45.0, "2025-06-01"),
+                  (1500, 30.0, 45.0, "2025-12-30")]
+    ledger.archive_rows(
+        2025, rows[:2], archive.summarise(2025, valid_rows)
+        )
+
+    assert archive.archive_closed_years(ledger, date(2026, 2, 1)) == 2
+    assert ledger.read_rows() == [["2000", "20", "32", "2026-01-05"]]
+    assert len(archived_rows("car", 2025)) == 2
+    assert ledger.read_summaries()[0].refuels == 2
+
+
+def test_zero_distance_refuel_after_the_archive_is_kept():
+    ledger = storage.MemoryStorage("car", [
+        ["1500", "30", "45", "2025-12-30"],
+        ["1500", "20", "30", "2026-01-02"],
+        ])
+
+    assert archive.archive_closed_years(ledger, date(2026, 2, 1)) == 1
+    assert ledger.read_rows() == [["1500", "20", "30", "2026-01-02"]]
+
+    # The next rollover archives the refuel at the same reading instead of
+    # taking it for the one already archived.
+    assert archive.archive_closed_years(ledger, date(2027, 1, 5)) == 1
+    assert ledger.read_rows() == []
+    assert archived_rows("car", 2026) == [["1500", "20", "30", "2026-01-02"]]
+    assert [summary.refuels for summary in ledger.read_summaries()] == [1, 1]
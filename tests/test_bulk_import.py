@@ -0,0 +1,35 @@
+from datetime import date, timedelta
+
+import bulk_import
+import storage
+
+
+def test_excel_csv_with_byte_order_mark_is_imported():
+    with open("refuels.csv", "w", encoding="utf-8-sig") as file:
+        file.write("odo,quantity,cost,date\n1000,30,45,2026-01-05\n")
+
+    ledger = storage.MemoryStorage("car")
+    assert bulk_import.import_refuels("refuels.csv", ledger) == 1
+    assert ledger.read_rows() == [["1000", "30", "45", "2026-01-05"]]
+
+
+def test_refuels_dated_in_the_future_are_rejected():
+    tomorrow = date.today() + timedelta(days=1)
+    with open("refuels.csv", "w", encoding="utf-8") as file:
+        file.write(f"1000,30,45,{tomorrow.isoformat()}\n")
+
+    ledger = storage.MemoryStorage("car")
+    assert bulk_import.import_refuels("refuels.csv", ledger) == 0
+    assert ledger.read_rows() == []
+
+
+def test_refuels_carry_on_from_the_last_stored_refuel():
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2026-01-05"],
+        ["1500", "30", "45", "2026-02-01"],
+        ])
+    with open("refuels.csv", "w", encoding="utf-8") as file:
+        file.write("1200,30,45,2026-03-01\n")
+
+    assert bulk_import.import_refuels("refuels.csv", ledger) == 0
+    assert len(ledger.read_rows()) == 2
@@ -0,0 +1,70 @@
+import threading
+from datetime import date
+
+import archive
+import fleet
+import storage
+
+
+def test_concurrent_fleet_summaries_all_complete():
+    for vehicle in ["car", "van", "truck"]:
+        storage.MemoryStorage(vehicle, [
+            ["1000", "30", "45", "2026-01-05"],
+            ["1500", "30", "45", "2026-02-01"],
+            ])
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                fleet.fleet_summary(storage.MemoryStorage)
+                ),
+            daemon=True,
+            )
+        for _ in range(4 * storage.POOL_SIZE)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(results) == len(threads)
+    summaries, skipped = results[0]
+    vehicles = [summary.vehicle for summary in summaries]
+    assert vehicles == ["car", "truck", "van"]
+    assert skipped == []
+
+
+def test_vehicles_with_invalid_ledgers_are_skipped():
+    storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2026-01-05"],
+        ["1500", "30", "45", "2026-02-01"],
+        ])
+    storage.MemoryStorage("van", [
+        ["5000", "30", "45", "2026-01-05"],
+        ["4000", "30", "45", "2026-02-01"],
+        ])
+    storage.MemoryStorage("truck", [
+        ["1000", "30", "45", "2026-01-05"],
+        ["1500", "90", "45", "2026-02-01"],
+        ])
+
+    summaries, skipped = fleet.fleet_summary(storage.MemoryStorage)
+    assert [summary.vehicle for summary in summaries] == ["car"]
+    assert sorted(skipped) == ["truck", "van"]
+
+
+def test_ledgers_carry_on_from_the_archived_refuels():
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2025-06-01"],
+        ["1500", "30", "45", "2025-09-01"],
+        ["2000", "30", "45", "2026-01-05"],
+        ])
+    archive.archive_closed_years(ledger, date(2026, 2, 1))
+    ledger.delete_rows(1)
+    ledger.append_rows([
+        ["1200", "30", "45", "2026-02-01"],
+        ["2500", "30", "45", "2026-03-01"],
+        ])
+
+    assert fleet.fleet_summary(storage.MemoryStorage) == ([], ["car"])
@@ -0,0 +1,91 @@
+from argparse import Namespace
+from datetime import date, timedelta
+
+import pytest
+
+import archive
+import cli
+import run
+import storage
+
+
+def history_rows():
+    """
+    Returns the rows of a ledger spanning the last two closed years and the
+    current one, with refuels every 40 days up to today.
+    """
+    first_date = date(date.today().year - 2, 1, 10)
+    rows = []
+    refuel_date = first_date
+    odo = 10000
+    while refuel_date <= date.today():
+        rows.append([
+            str(odo), str(30 + len(rows) % 5), str(45 + len(rows) % 7),
+            refuel_date.isoformat(),
+            ])
+        odo += 500 + 10 * (len(rows) % 3)
+        refuel_date += timedelta(days=40)
+    return rows
+
+
+@pytest.fixture
+def ledgers(monkeypatch):
+    """
+    Opens the same ledger twice with the in-memory backend, returning a
+    function to open the copy with its closed years archived or not.
+    """
+    monkeypatch.setenv("CFM_STORAGE", "memory")
+    rows = history_rows()
+    storage.MemoryStorage("archived", rows)
+    storage.MemoryStorage("live", rows)
+
+    def open_ledger(archived):
+        monkeypatch.setattr(archive, "ENABLED", archived)
+        run.open_ledger("archived" if archived else "live")
+        assert run.sync_data()
+
+    return open_ledger
+
+
+def test_closed_years_are_archived(ledgers):
+    ledgers(True)
+    assert len(storage.MemoryStorage("archived").read_summaries()) == 2
+    first_row = storage.MemoryStorage("archived").read_rows()[0]
+    assert first_row[3][:4] == str(date.today().year)
+
+
+def range_args(**bounds):
+    """Returns the command line arguments of a range query."""
+    args = dict(from_odo=None, to_odo=None, from_date=None, to_date=None)
+    args.update(bounds)
+    return Namespace(**args)
+
+
+@pytest.mark.parametrize("bounds", [
+    {"from_odo": 10000, "to_odo": 12000},
+    {"from_odo": 10900, "to_odo": 20000},
+    {"from_odo": 0, "to_odo": 10 ** 7},
+    {"from_date": f"{date.today().year - 2}-03-01",
+     "to_date": f"{date.today().year}-02-01"},
+    ])
+def test_ranges_span_archived_years(ledgers, bounds):
+    ledgers(False)
+    expected = cli.range_metrics(range_args(**bounds))
+    ledgers(True)
+    assert cli.range_metrics(range_args(**bounds)) == expected
+    assert expected is not None
+
+
+def test_rolling_windows_span_archived_years(ledgers):
+    ledgers(False)
+    expected = cli.rolling_metrics()
+    ledgers(True)
+    assert cli.rolling_metrics() == expected
+    assert expected["last_5_refuels"] is not None
+
+
+def test_totals_include_archived_years(ledgers):
+    ledgers(False)
+    expected = cli.total_metrics()
+    ledgers(True)
+    assert cli.total_metrics() == pytest.approx(expected)
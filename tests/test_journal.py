@@ -0,0 +1,140 @@
+import pytest
+
+import journal
+import storage
+
+
+def open_journal(ledger, known_rows=0):
+    """Returns a journal of the ledger in journal.jsonl, without flusher."""
+    return journal.Journal(
+        ledger, "journal.jsonl", background=False, known_rows=known_rows
+        )
+
+
+def test_saved_refuels_are_uploaded_in_order():
+    ledger = storage.MemoryStorage("car")
+    queue = open_journal(ledger)
+    queue.append([["1000", "30", "45", "2026-01-05"]])
+    queue.append([["1500", "20", "32", "2026-02-01"]])
+
+    assert queue.flush() == 2
+    assert [row[0] for row in ledger.read_rows()] == ["1000", "1500"]
+    assert queue.pending_rows() == []
+
+
+def test_same_refuel_saved_twice_is_uploaded_once():
+    ledger = storage.MemoryStorage("car")
+    queue = open_journal(ledger)
+    queue.append([["1000", "30", "45", "2026-01-05"]])
+    queue.append([["1000", "30", "45", "2026-01-05"]])
+
+    assert len(queue.pending_rows()) == 1
+    assert queue.flush() == 1
+    assert len(ledger.read_rows()) == 1
+
+
+def test_pending_refuels_are_uploaded_after_a_restart():
+    ledger = storage.MemoryStorage("car")
+    open_journal(ledger).append([["1000", "30", "45", "2026-01-05"]])
+
+    restarted = open_journal(ledger)
+    assert restarted.pending_rows() == [["1000", "30", "45", "2026-01-05"]]
+    assert restarted.flush() == 1
+    assert ledger.read_rows() == [["1000", "30", "45", "2026-01-05"]]
+    assert open_journal(ledger).pending_rows() == []
+
+
+class CrashingStorage(storage.MemoryStorage):
+    """
+    In-memory ledger whose uploads fail, after saving the rows if saved is
+    True, like an app stopped before journaling an upload.
+    """
+
+    saved = True
+
+    def append_rows(self, rows):
+        if self.saved:
+            super().append_rows(rows)
+        raise OSError("Connection lost.")
+
+
+def test_batch_uploaded_before_a_crash_is_not_uploaded_twice():
+    ledger = CrashingStorage("car", [
+        ["1000", "30", "45", "2026-01-05"],
+        ])
+    queue = open_journal(ledger, known_rows=1)
+    queue.append([["1500", "20", "32.0", "2026-02-01"]])
+    with pytest.raises(OSError):
+        queue.flush()
+
+    restarted = open_journal(storage.MemoryStorage("car"), known_rows=1)
+    assert restarted.flush() == 0
+    assert len(ledger.read_rows()) == 2
+    assert restarted.pending_rows() == []
+
+
+def test_batch_lost_before_the_ledger_is_uploaded_again():
+    ledger = CrashingStorage("car", [
+        ["1000", "30", "45", "2026-01-05"],
+        ])
+    ledger.saved = False
+    queue = open_journal(ledger, known_rows=1)
+    queue.append([["1500", "20", "32", "2026-02-01"]])
+    with pytest.raises(OSError):
+        queue.flush()
+
+    restarted = open_journal(storage.MemoryStorage("car"), known_rows=1)
+    assert restarted.flush() == 1
+    assert ledger.read_rows()[-1] == ["1500", "20", "32", "2026-02-01"]
+
+
+def test_pending_zero_distance_refuel_is_uploaded_after_a_restart():
+    ledger = storage.MemoryStorage("car", [
+        ["1500", "30", "45", "2026-01-05"],
+        ])
+    open_journal(ledger, known_rows=1).append(
+        [["1500", "20", "30", "2026-01-06"]]
+        )
+
+    restarted = open_journal(ledger, known_rows=1)
+    assert restarted.flush() == 1
+    assert ledger.read_rows()[-1] == ["1500", "20", "30", "2026-01-06"]
+
+
+def test_other_ledgers_keep_their_pending_refuels():
+    car = storage.MemoryStorage("car")
+    van = storage.MemoryStorage("van")
+    open_journal(car).append([["1000", "30", "45", "2026-01-05"]])
+
+    queue = open_journal(van)
+    queue.append([["5000", "35", "50", "2026-01-06"]])
+    assert queue.flush() == 1
+    assert open_journal(car).pending_rows() == [
+        ["1000", "30", "45", "2026-01-05"]
+        ]
+
+
+def test_processes_sharing_the_journal_keep_each_others_refuels():
+    ledger = storage.MemoryStorage("car")
+    first = open_journal(ledger)
+    second = open_journal(ledger)
+    first.append([["1000", "30", "45", "2026-01-05"]])
+    second.append([["1500", "20", "32", "2026-02-01"]])
+
+    assert second.flush() == 2
+    assert first.flush() == 0
+    assert [row[0] for row in ledger.read_rows()] == ["1000", "1500"]
+    assert open_journal(ledger).pending_rows() == []
+
+
+def test_refuels_pending_in_another_process_are_uploaded_once():
+    ledger = storage.MemoryStorage("car")
+    first = open_journal(ledger)
+    first.append([["1000", "30", "45", "2026-01-05"]])
+
+    second = open_journal(ledger)
+    assert second.pending_rows() == [["1000", "30", "45", "2026-01-05"]]
+    assert second.flush() == 1
+    assert first.flush() == 0
+    assert first.pending_rows() == []
+    assert len(ledger.read_rows()) == 1
@@ -0,0 +1,59 @@
+import threading
+from datetime import date
+
+import pytest
+
+import archive
+import service
+import storage
+
+
+@pytest.fixture
+def metrics_service():
+    """Returns a metrics service over the in-memory backend."""
+    return service.MetricsService(storage.MemoryStorage)
+
+
+def test_refuel_date_must_be_a_date_string(metrics_service):
+    storage.MemoryStorage("car", [["1000", "30", "45", "2026-01-05"]])
+    ledger = metrics_service.ledger("car")
+
+    with pytest.raises(ValueError, match="valid date"):
+        ledger.append([
+            {"odo": 1500, "quantity": 30, "cost": 45, "date": 20260201}
+            ])
+    assert len(storage.MemoryStorage("car").read_rows()) == 1
+
+
+def test_ledger_is_checked_against_the_archived_refuels(metrics_service):
+    ledger = storage.MemoryStorage("car", [
+        ["1000", "30", "45", "2025-06-01"],
+        ["1500", "30", "45", "2026-01-05"],
+        ])
+    archive.archive_closed_years(ledger, date(2026, 2, 1))
+    ledger.append_rows([["900", "30", "45", "2026-02-01"]])
+    ledger.delete_rows(1)
+
+    with pytest.raises(ValueError, match="rows 2"):
+        metrics_service.metrics("total", "car", {})
+
+
+def test_concurrent_rolling_metrics_agree(metrics_service):
+    storage.MemoryStorage("car", [
+        [str(1000 + 500 * i), "30", "45", f"2026-01-{i + 1:02d}"]
+        for i in range(20)
+        ])
+    expected = metrics_service.metrics("rolling", "car", {})
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            metrics_service.metrics("rolling", "car", {})
+            ))
+        for _ in range(16)
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [expected] * len(threads)
@@ -0,0 +1,97 @@
+import ledger_cache
+import snapshot
+
+
+ROWS = [
+    (1000, 30.0, 45.0, "2026-01-05"),
+    (1500, 20.0, 32.0, "2026-02-01"),
+    (2100, 35.5, 55.25, ""),
+    ]
+
+
+def open_cache(rows):
+    """Returns an in-memory ledger cache holding the rows."""
+    conn = ledger_cache.open_cache("memory:car", ":memory:")
+    ledger_cache.store_rows(conn, rows)
+    return conn
+
+
+def snapshot_rows(ledger):
+    """Returns every row of a snapshot."""
+    return [ledger.row(index) for index in range(ledger.row_count)]
+
+
+def test_snapshot_holds_the_cached_rows():
+    conn = open_cache(ROWS)
+    ledger = snapshot.load_snapshot(conn, "snapshot.bin")
+
+    assert snapshot_rows(ledger) == ROWS
+    odo, quantity, cost, dates = ledger.fuel_columns()
+    assert list(odo) == [1000, 1500, 2100]
+    assert list(dates) == ["2026-01-05", "2026-02-01", ""]
+
+
+def test_new_rows_are_appended_in_place():
+    conn = open_cache(ROWS[:2])
+    first = snapshot.load_snapshot(conn, "snapshot.bin")
+    ledger_cache.store_rows(conn, ROWS[2:])
+
+    ledger = snapshot.load_snapshot(conn, "snapshot.bin")
+    assert ledger.capacity == first.capacity
+    assert snapshot_rows(ledger) == ROWS
+
+
+def test_snapshot_is_rebuilt_once_full():
+    rows = [(1000 + i, 30.0, 45.0, "") for i in range(snapshot.MIN_CAPACITY)]
+    half = snapshot.MIN_CAPACITY // 2
+    conn = open_cache(rows[:half])
+    first = snapshot.load_snapshot(conn, "snapshot.bin")
+    ledger_cache.store_rows(conn, rows[half:])
+    full = snapshot.load_snapshot(conn, "snapshot.bin")
+    assert full.capacity == first.capacity == full.row_count
+    ledger_cache.store_rows(conn, [(5000, 30.0, 45.0, "")])
+
+    ledger = snapshot.load_snapshot(conn, "snapshot.bin")
+    assert ledger.capacity > first.capacity
+    assert snapshot_rows(ledger) == rows + [(5000, 30.0, 45.0, "")]
+
+
+def test_snapshot_is_rebuilt_after_the_cache_is_cleared():
+    conn = open_cache(ROWS)
+    snapshot.load_snapshot(conn, "snapshot.bin")
+    ledger_cache.clear_cache(conn)
+    ledger_cache.store_rows(conn, ROWS[:1])
+
+    ledger = snapshot.load_snapshot(conn, "snapshot.bin")
+    assert ledger.generation == ledger_cache.cache_generation(conn)
+    assert snapshot_rows(ledger) == ROWS[:1]
+
+
+def test_snapshot_is_rebuilt_when_the_ledger_was_edited():
+    conn = open_cache(ROWS)
+    snapshot.load_snapshot(conn, "snapshot.bin")
+    conn.execute("UPDATE refuels SET cost = 99.0 WHERE odo = 2100")
+    ledger_cache.store_rows(conn, [(2600, 30.0, 45.0, "")])
+
+    ledger = snapshot.load_snapshot(conn, "snapshot.bin")
+    assert ledger.row(2) == (2100, 35.5, 99.0, "")
+    assert ledger.row_count == 4
+
+
+def test_corrupt_snapshot_file_is_rebuilt():
+    conn = open_cache(ROWS)
+    with open("snapshot.bin", "wb") as snapshot_file:
+        snapshot_file.write(b"not a snapshot")
+
+    assert snapshot.open_snapshot("snapshot.bin") is None
+    assert snapshot_rows(snapshot.load_snapshot(conn, "snapshot.bin")) == ROWS
+
+
+def test_truncated_snapshot_file_is_rebuilt():
+    conn = open_cache(ROWS)
+    snapshot.load_snapshot(conn, "snapshot.bin")
+    with open("snapshot.bin", "r+b") as snapshot_file:
+        snapshot_file.truncate(snapshot.HEADER_SIZE + 8)
+
+    assert snapshot.open_snapshot("snapshot.bin") is None
+    assert snapshot_rows(snapshot.load_snapshot(conn, "snapshot.bin")) == ROWS
@@ -0,0 +1,92 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import locks
+
+
+# Access token cache setup:
+TOKEN_FILE = os.environ.get("CFM_TOKEN_FILE", "token_cache.json")
+# A cached token is reused until this long before it expires. Google's
+# client refreshes tokens within a few minutes of their expiry, so cached
+# tokens are always handed over with some validity left.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def token_key(creds):
+    """Returns the key of the tokens of a service account and its scopes."""
+    return " ".join([creds.service_account_email, *sorted(creds.scopes)])
+
+
+def read_token(path, key):
+    """
+    Function to read a cached access token.
+    Returns the token and its expiry, as a naive UTC datetime like Google's
+    client uses, or None if there is no token valid for REFRESH_MARGIN.
+    """
+    try:
+        with open(path) as token_file:
+            entry = json.load(token_file)[key]
+        expiry = datetime.fromisoformat(entry["expiry"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if expiry - REFRESH_MARGIN <= now:
+        return None
+    return entry["token"], expiry
+
+
+def write_token(path, key, token, expiry):
+    """
+    Function to cache an access token with its expiry, keeping the tokens
+    of other service accounts. The file is replaced atomically and only
+    readable by its owner, as the token grants access to the spreadsheet.
+    """
+    try:
+        with open(path) as token_file:
+            tokens = json.load(token_file)
+    except (OSError, ValueError):
+        tokens = {}
+    tokens[key] = {"token": token, "expiry": expiry.isoformat()}
+    temp_path = f"{path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as token_file:
+        json.dump(tokens, token_file)
+    os.replace(temp_path, path)
+
+
+def share_token(creds, path=TOKEN_FILE):
+    """
+    Function to make service account credentials share their access token
+    with every process of the app through the token file.
+    Loads the cached token if it is still valid, so the first request needs
+    no token exchange. When the token nears expiry, one process refreshes
+    it under the file lock and caches it; the others waiting for the lock
+    then reuse it. A cached token the same as the one being refreshed is
+    not reused, so a token rejected before its expiry is replaced.
+    Returns the credentials.
+    """
+    key = token_key(creds)
+    refresh = creds.refresh
+
+    def load_token(rejected=None):
+        cached = read_token(path, key)
+        if cached and cached[0] != rejected:
+            creds.token, creds.expiry = cached
+            return True
+        return False
+
+    def shared_refresh(request):
+        # The token being replaced may have been rejected (401) before its
+        # expiry, for example once revoked, so it is never reused.
+        rejected = creds.token
+        with locks.file_lock(path):
+            if not load_token(rejected):
+                refresh(request)
+                write_token(path, key, creds.token, creds.expiry)
+
+    load_token()
+    # Google's client calls refresh() whenever the token is not valid, and
+    # after a request is rejected as unauthorised.
+    creds.refresh = shared_refresh
+    return creds
@@ -0,0 +1,180 @@
+import math
+from collections import namedtuple
+from datetime import date
+
+
+# Refuel validation rules shared by the interactive input and bulk import:
+MAX_FUEL_QUANTITY = 40  # Maximum capacity of the fuel tank in litres.
+# A fuel price further than this fraction from the recent average price is
+# reported as an outlier.
+PRICE_TOLERANCE = 0.5
+# Weight of each refuel in the recent average price.
+PRICE_SMOOTHING = 0.2
+
+# Problem found in a ledger row. Warnings flag unusual but possible values,
+# which do not stop the row from being used.
+RowIssue = namedtuple("RowIssue", ["row", "column", "message", "warning"])
+
+
+def odo_error(odo_data, last_odo=None):
+    """
+    Function to check an odometer reading against the validation rules.
+    Checks if the data is an integer.
+    Checks if the data is not less than the last reading, if there is one.
+    Returns the error message, or None if the reading is valid.
+    """
+    if not odo_data.isdigit():
+        return "Odometer readings data must be an integer."
+    if last_odo is not None and int(odo_data) < last_odo:
+        return "Odometer reading must be greater than the last reading."
+    return None
+
+
+def fuel_error(fuel_quantity, fuel_cost):
+    """
+    Function to check fueling data against the validation rules.
+    Checks if the data is a float.
+    Checks if the data is greater than 0.
+    Checks if the fuel quantity does not exceed the fuel tank capacity.
+    Returns the error message, or None if the data is valid.
+    """
+    try:
+        fuel_quantity_float = float(fuel_quantity)
+        fuel_cost_float = float(fuel_cost)
+    except ValueError:
+        return "Invalid input. Fuel quantity and cost must be numeric values."
+
+    if fuel_quantity_float <= 0:
+        return "Fuel quantity must be greater than 0."
+    elif fuel_quantity_float > MAX_FUEL_QUANTITY:
+        return f"Fuel quantity must not exceed {MAX_FUEL_QUANTITY}."
+    elif fuel_cost_float <= 0:
+        return "Fuel cost must be greater than 0."
+    return None
+
+
+def date_error(date_data, today=None):
+    """
+    Function to check a refuel date against the validation rules.
+    Refuels saved before dates were recorded have an empty date.
+    Checks if any other date is a valid YYYY-MM-DD date.
+    Checks if the date is not after today, if given, for new refuels.
+    Returns the error message, or None if the date is valid.
+    """
+    if not date_data:
+        return None
+    try:
+        valid = len(date_data) == 10 and bool(date.fromisoformat(date_data))
+    except ValueError:
+        valid = False
+    if not valid:
+        return "Refuel date must be a valid date (YYYY-MM-DD)."
+    if today is not None and date_data > today.isoformat():
+        return "Refuel date must not be in the future."
+    return None
+
+
+def validate_ledger(numbered_rows, previous=None, today=None):
+    """
+    Function to validate ledger rows in a single pass, reporting every
+    offending row instead of stopping at the first one.
+    Checks the type and rules of each value, that odometer readings and
+    refuel dates never go backwards, trips of zero distance and fuel prices
+    far from the recent average price.
+    Takes (row number, row) pairs, and the validated row before them, if
+    any, to carry the checks on from it. Dates after today, if given, are
+    invalid, for new refuels.
+    Returns the valid rows as (odo, quantity, cost, date) tuples and the
+    RowIssues found.
+    """
+    valid_rows = []
+    issues = []
+    last_odo, last_date = (None, "")
+    if previous:
+        last_odo, last_date = previous[0], previous[3]
+    average_price = previous[2] / previous[1] if previous else None
+    for row_number, row in numbered_rows:
+        odo_data, fuel_quantity, fuel_cost, refuel_date = (
+            [str(value).strip() for value in row[:4]] + [""] * 4
+            )[:4]
+        row_issues = []
+
+        error = odo_error(odo_data)
+        if error:
+            row_issues.append(RowIssue(row_number, "odo", error, False))
+        elif last_odo is not None and int(odo_data) < last_odo:
+            row_issues.append(RowIssue(
+                row_number, "odo",
+                "Odometer reading is lower than the previous one "
+                f"({last_odo}).", False
+                ))
+        elif last_odo is not None and int(odo_data) == last_odo:
+            row_issues.append(RowIssue(
+                row_number, "odo", "Zero distance since the previous refuel.",
+                True
+                ))
+
+        quantity = _positive_number(
+            fuel_quantity, "Fuel quantity", row_number, "quantity", row_issues
+            )
+        if quantity is not None and quantity > MAX_FUEL_QUANTITY:
+            quantity = None
+            row_issues.append(RowIssue(
+                row_number, "quantity",
+                f"Fuel quantity must not exceed {MAX_FUEL_QUANTITY}.", False
+                ))
+        cost = _positive_number(
+            fuel_cost, "Fuel cost", row_number, "cost", row_issues
+            )
+
+        error = date_error(refuel_date, today)
+        if error:
+            row_issues.append(RowIssue(row_number, "date", error, False))
+        elif refuel_date and refuel_date < last_date:
+            row_issues.append(RowIssue(
+                row_number, "date",
+                f"Refuel date is earlier than the previous one ({last_date}).",
+                False
+                ))
+
+        if quantity is not None and cost is not None:
+            price = cost / quantity
+            if average_price is None:
+                average_price = price
+            elif abs(price - average_price) > PRICE_TOLERANCE * average_price:
+                row_issues.append(RowIssue(
+                    row_number, "cost",
+                    f"Fuel price of {price:.2f}EUR/l is far from the recent "
+                    f"average of {average_price:.2f}EUR/l.", True
+                    ))
+            else:
+                average_price += PRICE_SMOOTHING * (price - average_price)
+
+        issues.extend(row_issues)
+        if all(issue.warning for issue in row_issues):
+            last_odo = int(odo_data)
+            last_date = refuel_date or last_date
+            valid_rows.append((last_odo, quantity, cost, refuel_date))
+    return valid_rows, issues
+
+
+def _positive_number(value, label, row_number, column, row_issues):
+    """
+    Parses a value that must be a number greater than 0.
+    Returns the number, or None after adding a RowIssue if it is invalid.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        row_issues.append(RowIssue(
+            row_number, column, f"{label} must be a numeric value.", False
+            ))
+        return None
+    if number <= 0:
+        row_issues.append(RowIssue(
+            row_number, column, f"{label} must be greater than 0.", False
+            ))
+        return None
+    return number